@@ -0,0 +1,11 @@
+"""Benchmarks for the SPL-T engine and environment.
+
+Run them from the repository root with
+
+    python -m benchmarks
+
+which times `core.makeMove`, `SpltEnv.step`, `SpltEnv._get_state` and
+`split_x_y` on fixed, seeded games for each board size, writes the results
+as JSON and compares them with the stored baseline in
+`benchmarks/baseline.json`. See `python -m benchmarks --help`.
+"""
@@ -0,0 +1,96 @@
+"""Command line for the benchmark suite, see `python -m benchmarks --help`.
+
+Exits with status 1 if any metric regressed against the baseline, so it can
+gate changes to the engine.
+"""
+import argparse
+import json
+import os
+import sys
+
+from benchmarks import suite
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baseline.json')
+
+
+def format_row(name, old, new, change, status):
+    return '{:<36} {:>12.2f} {:>12.2f} {:>+8.1%}  {}'.format(
+        name, old, new, change, status)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Time core.makeMove and SpltEnv on fixed seeded games, '
+                    'and compare the results with a baseline.')
+    parser.add_argument('--sizes', default=','.join(
+        suite.size_name(width, height) for width, height in suite.SIZES),
+        help='comma separated board sizes as WIDTHxHEIGHT '
+             '(default: %(default)s)')
+    parser.add_argument('--games', type=int, default=10,
+                        help='games played on each size')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs of each case, the best one is kept')
+    parser.add_argument('--output', default=None,
+                        help='write the results here as JSON')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='results to compare with (default: the stored '
+                             'baseline)')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative change that counts as a regression '
+                             '(default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline instead '
+                             'of comparing with it')
+    args = parser.parse_args(argv)
+
+    sizes = [suite.parse_size(size) for size in args.sizes.split(',')]
+
+    def report(width, height, metrics):
+        for name, metric in sorted(metrics.items()):
+            print('{:<36} {:>12.2f} {}'.format(name, metric['value'],
+                                               metric['unit']))
+        sys.stdout.flush()
+
+    results = suite.run(sizes, args.games, args.seed, args.repeat,
+                        callback=report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(args.baseline))
+        return 0
+    if not os.path.exists(args.baseline):
+        print('No baseline at {}, nothing to compare with'.format(
+            args.baseline))
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    rows = suite.compare(results, baseline, args.threshold)
+    print()
+    print('Compared with {} ({})'.format(args.baseline,
+                                         baseline['meta'].get('time')))
+    for key in ('platform', 'python', 'numpy', 'games', 'seed'):
+        if baseline['meta'].get(key) != results['meta'][key]:
+            print('Warning: the baseline has {} {!r}, this run has {!r}'
+                  .format(key, baseline['meta'].get(key),
+                          results['meta'][key]))
+    print('{:<36} {:>12} {:>12} {:>8}'.format('metric', 'baseline', 'now',
+                                              'change'))
+    for row in rows:
+        print(format_row(*row))
+    regressions = [row for row in rows if row[4] == 'regression']
+    if regressions:
+        print('{} metric(s) regressed by more than {:.0%}'.format(
+            len(regressions), args.threshold))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
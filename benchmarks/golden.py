@@ -0,0 +1,336 @@
+"""Golden traces of `core.makeMove`, and a harness that checks other engines
+against them.
+
+A faster engine has to reproduce every quirk of the original game exactly:
+voids of odd depth are only partly filled, voids that were already there
+are only filled after something falls, halved points round up, and so on.
+Rather than list them, the corpus records what the engine does on a few
+hundred seeded games, after every move: the boxes (x, y, width, height,
+points) in order, the score, the next split direction and whether the move
+was legal. About one move in twenty tries to split a box at random, so
+rejected moves are covered too. Odd board sizes are included, as they
+leave voids when boxes split.
+
+An engine is anything with the three methods of `Engine`. Engines are
+registered by name in `ENGINES`; `core`, `core-cached` (makeMove through
+a TransitionCache) and `core-undo` (every move is made, undone, checked
+and made again) are built in, and `module:attribute` names an engine
+elsewhere. To check one and time it on the same workload:
+
+    python -m benchmarks.golden --engine core-cached
+    python -m benchmarks.golden --engine mypackage.engines:fast_engine
+
+After a deliberate change to the rules, rebuild the corpus with
+`--generate`.
+"""
+import argparse
+import importlib
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+from gym_splt import core
+
+CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'golden.npz')
+
+# (width, height, number of games)
+GAMES = [(4, 8, 100), (5, 9, 50), (8, 16, 60), (7, 13, 30), (16, 32, 6)]
+
+ILLEGAL_MOVE_RATE = 0.05
+
+
+class Engine(object):
+    """Plays moves on boards of `gym_splt.core`, or any engine with the same
+    interface: a Board class and a makeMove function."""
+
+    def __init__(self, module=core, cache=None):
+        self.module = module
+        self.cache = cache
+
+    def new_board(self, width, height):
+        return self.module.Board(width=width, height=height)
+
+    def make_move(self, board, box):
+        """Split box number `box`. Returns False, leaving the board as it
+        was, if the move is not legal."""
+        if self.cache is not None:
+            return self.module.makeMove(board, box, cache=self.cache)
+        return self.module.makeMove(board, box)
+
+    def state(self, board):
+        """Return (boxes, score, vertical): boxes is an (n, 5) array of x,
+        y, width, height and points in the order of the board's boxes, and
+        vertical is True if the next split is vertical."""
+        boxes = np.array([(box.x, box.y, box.width, box.height, box.points)
+                          for box in board.box], dtype=np.int64)
+        return (boxes.reshape(-1, 5), board.score,
+                board.splitAction == core.VERTICAL)
+
+
+class UndoMismatch(Exception):
+    """Raised by `UndoEngine` when undoing a move does not give back the
+    board as it was before the move."""
+
+
+class UndoEngine(Engine):
+    """Checks `core.undoMove` while playing: every move is made, undone and
+    compared with a copy of the board taken before it, then made again.
+
+    The copy is restored from a snapshot, so besides the boxes (compared
+    with `Board.__eq__`) the order of the boxes, score, splitRecord and
+    occupancy index must all come back, and so must the legal move index.
+    """
+
+    def make_move(self, board, box):
+        before = self.module.Board(width=board.width, height=board.height)
+        before.restore(board.snapshot())
+        if not self.module.makeMove(board, box, undo=True):
+            return False
+        self.module.undoMove(board)
+        if (board != before or board.snapshot() != before.snapshot()
+                or (board.splittable != before.splittable).any()):
+            raise UndoMismatch(
+                'Undoing a split of box {} after move {} did not restore '
+                'the board'.format(box, len(board.splitRecord)))
+        return self.module.makeMove(board, box)
+
+
+ENGINES = {
+    'core': lambda: Engine(),
+    'core-cached': lambda: Engine(cache=core.TransitionCache()),
+    'core-undo': lambda: UndoEngine(),
+}
+
+
+def register_engine(name, factory):
+    """Make an engine available by name. `factory()` returns a new engine."""
+    ENGINES[name] = factory
+
+
+def get_engine(name):
+    """Create a registered engine, or one given as 'module:attribute', where
+    the attribute is an engine or a factory of engines."""
+    if name in ENGINES:
+        return ENGINES[name]()
+    if ':' not in name:
+        raise ValueError('Unknown engine {!r}, expected one of {} or '
+                         'module:attribute'.format(name, sorted(ENGINES)))
+    module, attribute = name.split(':', 1)
+    engine = getattr(importlib.import_module(module), attribute)
+    return engine() if callable(engine) else engine
+
+
+class Corpus(object):
+    """Golden traces of many games, stored as flat arrays.
+
+    Game g is played on a board of `sizes[g]` and its moves are rows
+    `game_start[g]` to `game_start[g + 1]` of the per-move arrays: the box
+    that was chosen (`moves`), whether the move was `legal`, and the
+    `scores` and `vertical` split direction after it. The boxes after move
+    m are rows `box_start[m]` to `box_start[m + 1]` of `boxes`.
+    """
+
+    fields = ['sizes', 'seeds', 'game_start', 'moves', 'legal', 'scores',
+              'vertical', 'box_start', 'boxes']
+
+    def __init__(self, **arrays):
+        for name in self.fields:
+            setattr(self, name, arrays[name])
+
+    def __len__(self):
+        return len(self.sizes)
+
+    @property
+    def n_moves(self):
+        return len(self.moves)
+
+    def game(self, g):
+        """Return (width, height, seed, first move, end move) of game g."""
+        width, height = (int(n) for n in self.sizes[g])
+        return (width, height, int(self.seeds[g]), int(self.game_start[g]),
+                int(self.game_start[g + 1]))
+
+    def boxes_after(self, move):
+        return self.boxes[self.box_start[move]:self.box_start[move + 1]]
+
+    def save(self, path):
+        np.savez_compressed(path, **{name: getattr(self, name)
+                                     for name in self.fields})
+
+    @classmethod
+    def load(cls, path=CORPUS):
+        with np.load(path) as data:
+            return cls(**{name: data[name] for name in cls.fields})
+
+
+def generate(games=GAMES, seed=0, engine=None):
+    """Play the seeded games with `engine` (default: core) and record them."""
+    if engine is None:
+        engine = Engine()
+    sizes, seeds, game_start = [], [], [0]
+    moves, legal, scores, vertical = [], [], [], []
+    box_start, boxes = [0], []
+    for width, height, n_games in games:
+        for game_seed in range(seed, seed + n_games):
+            rng = random.Random('{}-{}x{}'.format(game_seed, width, height))
+            board = engine.new_board(width, height)
+            while True:
+                options = board.getMoveOptions()
+                if not options:
+                    break
+                if rng.random() < ILLEGAL_MOVE_RATE:
+                    box = rng.randrange(len(board.box))
+                else:
+                    box = rng.choice(options)
+                moves.append(box)
+                legal.append(engine.make_move(board, box))
+                board_boxes, score, is_vertical = engine.state(board)
+                scores.append(score)
+                vertical.append(is_vertical)
+                boxes.append(board_boxes)
+                box_start.append(box_start[-1] + len(board_boxes))
+            sizes.append((width, height))
+            seeds.append(game_seed)
+            game_start.append(len(moves))
+    boxes = np.concatenate(boxes)
+    if boxes.max() > np.iinfo(np.int16).max:
+        raise ValueError('Box fields over {} do not fit in the corpus'
+                         .format(np.iinfo(np.int16).max))
+    return Corpus(
+        sizes=np.array(sizes, dtype=np.int32).reshape(-1, 2),
+        seeds=np.array(seeds, dtype=np.int64),
+        game_start=np.array(game_start, dtype=np.int64),
+        moves=np.array(moves, dtype=np.int32),
+        legal=np.array(legal, dtype=bool),
+        scores=np.array(scores, dtype=np.int64),
+        vertical=np.array(vertical, dtype=bool),
+        box_start=np.array(box_start, dtype=np.int64),
+        boxes=boxes.astype(np.int16))
+
+
+class Divergence(object):
+    """Where an engine first stopped matching the corpus."""
+
+    def __init__(self, game, width, height, seed, move, box, field,
+                 expected, actual):
+        self.game = game
+        self.width = width
+        self.height = height
+        self.seed = seed
+        self.move = move
+        self.box = box
+        self.field = field
+        self.expected = expected
+        self.actual = actual
+
+    def __str__(self):
+        return ('Game {} ({}x{}, seed {}) diverged at move {} (box {}): {} '
+                'is {}, expected {}'.format(
+                    self.game, self.width, self.height, self.seed, self.move,
+                    self.box, self.field, self.actual, self.expected))
+
+
+def _compare(corpus, m, legal, state):
+    """Return (field, expected, actual) for the first difference between
+    move m of the corpus and what the engine did, or None."""
+    if legal != corpus.legal[m]:
+        return 'legal', bool(corpus.legal[m]), legal
+    boxes, score, vertical = state
+    if score != corpus.scores[m]:
+        return 'score', int(corpus.scores[m]), score
+    if vertical != corpus.vertical[m]:
+        return 'vertical', bool(corpus.vertical[m]), vertical
+    expected = corpus.boxes_after(m)
+    if len(boxes) != len(expected):
+        return 'number of boxes', len(expected), len(boxes)
+    different = np.flatnonzero((np.asarray(boxes) != expected).any(axis=1))
+    if len(different):
+        i = different[0]
+        return ('box {} (x, y, width, height, points)'.format(i),
+                tuple(int(n) for n in expected[i]),
+                tuple(int(n) for n in boxes[i]))
+    return None
+
+
+def replay(engine, corpus, verify=True):
+    """Play every game of the corpus with the engine.
+
+    Returns (moves, seconds, divergence): the moves played, the time spent
+    in `make_move` and, if `verify`, the first Divergence or None. Without
+    `verify` the engine is only timed, and the games are played to the end
+    whatever it does.
+    """
+    clock = time.perf_counter
+    seconds = 0.0
+    played = 0
+    for g in range(len(corpus)):
+        width, height, seed, begin, end = corpus.game(g)
+        board = engine.new_board(width, height)
+        make_move = engine.make_move
+        for m in range(begin, end):
+            box = int(corpus.moves[m])
+            start = clock()
+            legal = make_move(board, box)
+            seconds += clock() - start
+            played += 1
+            if verify:
+                difference = _compare(corpus, m, legal, engine.state(board))
+                if difference is not None:
+                    return played, seconds, Divergence(
+                        g, width, height, seed, m - begin, box, *difference)
+    return played, seconds, None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.golden',
+        description='Check an engine against the golden traces of core, and '
+                    'time it on them.')
+    parser.add_argument('--engine', action='append', default=None,
+                        help='one of {} or module:attribute; can be given '
+                             'more than once (default: core)'.format(
+                                 ', '.join(sorted(ENGINES))))
+    parser.add_argument('--corpus', default=CORPUS)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timed runs after the check, the best one is '
+                             'reported')
+    parser.add_argument('--generate', action='store_true',
+                        help='rebuild the corpus with core instead of '
+                             'checking engines')
+    args = parser.parse_args(argv)
+
+    if args.generate:
+        corpus = generate()
+        corpus.save(args.corpus)
+        print('Wrote {} games, {} moves to {}'.format(
+            len(corpus), corpus.n_moves, args.corpus))
+        return 0
+
+    corpus = Corpus.load(args.corpus)
+    failed = False
+    for name in args.engine or ['core']:
+        try:
+            moves, _, divergence = replay(get_engine(name), corpus)
+        except UndoMismatch as mismatch:
+            print('{}: FAILED. {}'.format(name, mismatch))
+            failed = True
+            continue
+        if divergence is not None:
+            print('{}: FAILED after {} moves. {}'.format(name, moves,
+                                                         divergence))
+            failed = True
+            continue
+        best = min(replay(get_engine(name), corpus, verify=False)[1]
+                   for _ in range(args.repeat))
+        print('{}: matches all {} games, {} moves; {:.0f} moves/s'.format(
+            name, len(corpus), moves, moves / best if best else 0))
+        sys.stdout.flush()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,262 @@
+"""The benchmark cases, and comparison of their results with a baseline.
+
+Every case replays the same games: `games(width, height, n_games, seed)`
+plays random legal moves chosen with a seeded generator. Moves are chosen
+by the position of the box on the board rather than its index in
+`board.box`, so the games stay the same when the engine's internals
+change, and results of different versions can be compared. The games are
+played and looked up through `getMoveOptions` and the box list alone, so
+the suite runs unchanged on the original engine.
+
+Results are a flat dict from metric name, such as '8x16/make_move/p50_us',
+to a dict with the 'value', its 'unit' and whether higher is better. Each
+case is measured `repeat` times and the best run is kept, which filters
+out most of the noise from other processes.
+"""
+import gc
+import platform
+import random
+import sys
+import time
+
+import numpy as np
+
+from gym_splt import core
+from gym_splt.envs.splt_env import SpltEnv, split_x_y
+
+SIZES = [(4, 8), (8, 16), (16, 32)]
+
+PERCENTILES = [50, 90, 99]
+
+
+def size_name(width, height):
+    return '{}x{}'.format(width, height)
+
+
+def parse_size(text):
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def games(width, height, n_games, seed=0):
+    """Play `n_games` seeded random games. Returns a list of games, each a
+    list of the cell actions (y * width + x) that were played."""
+    rng = random.Random('{}-{}x{}'.format(seed, width, height))
+    played = []
+    for _ in range(n_games):
+        board = core.Board(width=width, height=height)
+        actions = []
+        while True:
+            # The top left corner of each splittable box, in reading order
+            options = sorted((board.box[i].y, board.box[i].x, i)
+                             for i in board.getMoveOptions())
+            if not options:
+                break
+            y, x, box = rng.choice(options)
+            core.makeMove(board, box)
+            actions.append(y * width + x)
+        played.append(actions)
+    return played
+
+
+def box_at(board, x, y):
+    """Return the index in `board.box` of the box covering a cell, or None
+    for a void. Only the box list is used, so that the suite also runs on
+    versions of core without an occupancy index."""
+    for i, box in enumerate(board.box):
+        if box.x <= x < box.x + box.width and box.y <= y < box.y + box.height:
+            return i
+    return None
+
+
+def _illegal_cells(board):
+    """Return the (x, y) of every cell that is not a legal move."""
+    legal = set()
+    for i in board.getMoveOptions():
+        box = board.box[i]
+        legal.update((x, y) for x in range(box.x, box.x + box.width)
+                     for y in range(box.y, box.y + box.height))
+    return [(x, y) for y in range(board.height) for x in range(board.width)
+            if (x, y) not in legal]
+
+
+class _NoGC(object):
+    """Keeps the garbage collector out of the timings, like timeit does."""
+
+    def __enter__(self):
+        self.enabled = gc.isenabled()
+        gc.disable()
+
+    def __exit__(self, *exc_info):
+        if self.enabled:
+            gc.enable()
+
+
+def time_make_move(width, height, played):
+    """Return the latency in seconds of every makeMove call in the games."""
+    latencies = []
+    clock = time.perf_counter
+    for actions in played:
+        board = core.Board(width=width, height=height)
+        for action in actions:
+            box = box_at(board, action % width, action // width)
+            start = clock()
+            core.makeMove(board, box)
+            latencies.append(clock() - start)
+    return np.array(latencies)
+
+
+def time_env_step(width, height, played):
+    """Return (steps, seconds) for playing the games through SpltEnv.step,
+    including the reset at the start of each game."""
+    env = SpltEnv(width=width, height=height, max_time=sys.maxsize)
+    steps = 0
+    start = time.perf_counter()
+    for actions in played:
+        env.reset()
+        for action in actions:
+            env.step(action)
+        steps += len(actions)
+    return steps, time.perf_counter() - start
+
+
+def _positions(width, height, played, every=4):
+    """Yield an env at every `every`-th position of the games."""
+    env = SpltEnv(width=width, height=height, max_time=sys.maxsize)
+    for actions in played:
+        env.reset()
+        for move, action in enumerate(actions):
+            if move % every == 0:
+                yield env
+            env.step(action)
+
+
+def time_get_state(width, height, played, calls=20):
+    """Return (calls, seconds) spent in `_get_state` on positions of the
+    games."""
+    total_calls = 0
+    seconds = 0.0
+    for env in _positions(width, height, played):
+        get_state = env._get_state
+        start = time.perf_counter()
+        for _ in range(calls):
+            get_state()
+        seconds += time.perf_counter() - start
+        total_calls += calls
+    return total_calls, seconds
+
+
+def time_split_x_y_lookup(width, height, played):
+    """Return (calls, seconds) spent in `split_x_y` on every cell that is
+    not a legal move, on positions of the games. Such calls look up the
+    box and reject the move without changing the board, which is what
+    `SpltEnv.step` does for every impossible action."""
+    total_calls = 0
+    seconds = 0.0
+    for env in _positions(width, height, played):
+        board = env.board
+        cells = _illegal_cells(board)
+        if not cells:
+            continue
+        start = time.perf_counter()
+        for x, y in cells:
+            split_x_y(board, x, y)
+        seconds += time.perf_counter() - start
+        total_calls += len(cells)
+    return total_calls, seconds
+
+
+def _metric(value, unit, higher_is_better=False):
+    return {'value': value, 'unit': unit,
+            'higher_is_better': higher_is_better}
+
+
+def run_size(width, height, n_games=10, seed=0, repeat=5):
+    """Run every case on one board size. Returns its metrics."""
+    played = games(width, height, n_games, seed)
+    prefix = size_name(width, height) + '/'
+    results = {}
+    for _ in range(repeat):
+        with _NoGC():
+            latencies = time_make_move(width, height, played)
+            steps, step_seconds = time_env_step(width, height, played)
+            state_calls, state_seconds = time_get_state(width, height, played)
+            lookup_calls, lookup_seconds = time_split_x_y_lookup(
+                width, height, played)
+        run = {
+            'make_move/mean_us': latencies.mean() * 1e6,
+            'env_step/steps_per_s': steps / step_seconds,
+            'get_state/mean_us': state_seconds / state_calls * 1e6,
+            'split_x_y_lookup/mean_us':
+                lookup_seconds / lookup_calls * 1e6 if lookup_calls else 0.0,
+        }
+        for percentile, value in zip(
+                PERCENTILES, np.percentile(latencies, PERCENTILES)):
+            run['make_move/p{}_us'.format(percentile)] = value * 1e6
+        for name, value in run.items():
+            higher_is_better = name.endswith('_per_s')
+            unit = 'steps/s' if higher_is_better else 'us'
+            name = prefix + name
+            if name in results:
+                pick = max if higher_is_better else min
+                value = pick(value, results[name]['value'])
+            results[name] = _metric(float(value), unit, higher_is_better)
+    results[prefix + 'moves'] = _metric(
+        sum(len(actions) for actions in played), 'moves')
+    return results
+
+
+def run(sizes=SIZES, n_games=10, seed=0, repeat=5, callback=None):
+    """Run the suite on every board size. Returns a results document, with
+    the settings and machine under 'meta' and the metrics under
+    'results'. `callback(width, height, metrics)` is called after each
+    size."""
+    results = {}
+    for width, height in sizes:
+        metrics = run_size(width, height, n_games, seed, repeat)
+        results.update(metrics)
+        if callback is not None:
+            callback(width, height, metrics)
+    meta = {
+        'sizes': [size_name(width, height) for width, height in sizes],
+        'games': n_games,
+        'seed': seed,
+        'repeat': repeat,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    return {'meta': meta, 'results': results}
+
+
+def compare(results, baseline, threshold=0.1):
+    """Compare two results documents metric by metric.
+
+    Returns a list of (name, baseline value, value, change, status) for the
+    metrics in both, where change is the relative change of the value and
+    status is 'regression' if it got worse by more than `threshold`,
+    'improvement' if it got better by more than that, and 'ok' otherwise.
+    Metrics that are not timings, such as the number of moves, are
+    'changed' if they differ at all, as the games were not the same.
+    """
+    rows = []
+    for name, metric in sorted(results['results'].items()):
+        if name not in baseline['results']:
+            continue
+        old = baseline['results'][name]['value']
+        new = metric['value']
+        change = (new - old) / old if old else 0.0
+        if metric['unit'] == 'moves':
+            status = 'changed' if new != old else 'ok'
+        else:
+            worse = -change if metric['higher_is_better'] else change
+            if worse > threshold:
+                status = 'regression'
+            elif worse < -threshold:
+                status = 'improvement'
+            else:
+                status = 'ok'
+        rows.append((name, old, new, change, status))
+    return rows
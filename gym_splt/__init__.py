@@ -3,4 +3,19 @@ from gym.envs.registration import register
 register(
     id='splt-v0',
     entry_point='gym_splt.envs:SpltEnv'
-)
\ No newline at end of file
+)
+
+register(
+    id='splt-vec-v0',
+    entry_point='gym_splt.envs:SpltVecEnv'
+)
+
+register(
+    id='splt-subproc-vec-v0',
+    entry_point='gym_splt.envs:SpltSubprocVecEnv'
+)
+
+register(
+    id='splt-client-v0',
+    entry_point='gym_splt.client:SpltClientEnv'
+)
@@ -0,0 +1,261 @@
+"""Brute-force search for high SPL-T scores by playing lots of games.
+
+In the spirit of brute_spl-t: games are played with a simple policy (by
+default uniformly random legal moves) across a pool of worker processes.
+Games are handed out in numbered chunks, and every chunk is seeded from
+the base seed and its number, so a run gives the same results whatever
+the number of workers, and a run resumed from a checkpoint gives the
+same results as one that was never interrupted.
+
+Usage:
+    splt-brute --games 100000 --width 8 --height 16 --checkpoint run.json
+"""
+import argparse
+import heapq
+import importlib
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+from gym_splt import core
+
+
+def random_policy(board, move_options, rng):
+    return rng.choice(move_options)
+
+
+def biggest_box_policy(board, move_options, rng):
+    """Split the largest splittable box, breaking ties at random."""
+    areas = [board.box[i].width * board.box[i].height for i in move_options]
+    biggest = max(areas)
+    return rng.choice([i for i, area in zip(move_options, areas)
+                       if area == biggest])
+
+
+POLICIES = {
+    'random': random_policy,
+    'biggest': biggest_box_policy,
+}
+
+
+def get_policy(name):
+    """Look up a policy by name, or import one given as 'module:function'.
+
+    A policy is called as policy(board, move_options, rng) and returns one
+    of move_options.
+    """
+    if name in POLICIES:
+        return POLICIES[name]
+    if ':' not in name:
+        raise ValueError('Unknown policy {!r}, expected one of {} or '
+                         'module:function'.format(name, sorted(POLICIES)))
+    module, function = name.split(':', 1)
+    return getattr(importlib.import_module(module), function)
+
+
+def play_game(width, height, policy, rng):
+    """Play one game to the end. Returns (score, splitRecord)."""
+    board = core.Board(width=width, height=height)
+    move_options = board.getMoveOptions()
+    while move_options:
+        core.makeMove(board, policy(board, move_options, rng))
+        move_options = board.getMoveOptions()
+    return board.score, board.splitRecord
+
+
+def chunk_seed(seed, chunk):
+    return '{}-{}'.format(seed, chunk)
+
+
+def run_chunk(task):
+    """Play one chunk of games. Returns (chunk, histogram, best), where best
+    is a list of (score, splitRecord) for the top games of the chunk."""
+    chunk, games, width, height, policy_name, seed, top = task
+    policy = get_policy(policy_name)
+    rng = random.Random(chunk_seed(seed, chunk))
+    histogram = {}
+    best = []
+    for _ in range(games):
+        score, record = play_game(width, height, policy, rng)
+        histogram[score] = histogram.get(score, 0) + 1
+        if len(best) < top:
+            heapq.heappush(best, (score, record))
+        elif score > best[0][0]:
+            heapq.heapreplace(best, (score, record))
+    return chunk, histogram, sorted(best, reverse=True)
+
+
+class BruteState(object):
+    """Results so far of a brute-force run, which can be saved and resumed."""
+
+    def __init__(self, width, height, policy, seed, games, chunk_size, top):
+        self.width = width
+        self.height = height
+        self.policy = policy
+        self.seed = seed
+        self.games = games
+        self.chunk_size = chunk_size
+        self.top = top
+        self.done_chunks = set()
+        self.histogram = {}
+        self.best = []
+
+    @property
+    def n_chunks(self):
+        return -(-self.games // self.chunk_size)
+
+    @property
+    def games_played(self):
+        return sum(self.histogram.values())
+
+    def chunk_size_of(self, chunk):
+        return min(self.chunk_size, self.games - chunk * self.chunk_size)
+
+    def pending_chunks(self):
+        return [chunk for chunk in range(self.n_chunks)
+                if chunk not in self.done_chunks]
+
+    def add(self, chunk, histogram, best):
+        """Merge the result of one chunk. Returns True if it holds a new best
+        score."""
+        previous_best = self.best[0][0] if self.best else None
+        self.done_chunks.add(chunk)
+        for score, count in histogram.items():
+            self.histogram[score] = self.histogram.get(score, 0) + count
+        # Sort on (score, chunk) so ties are broken the same way on resume
+        merged = self.best + [(score, record, chunk) for score, record in best]
+        merged.sort(key=lambda entry: (-entry[0], entry[2]))
+        self.best = merged[:self.top]
+        return previous_best is None or self.best[0][0] > previous_best
+
+    def to_dict(self):
+        return {
+            'width': self.width,
+            'height': self.height,
+            'policy': self.policy,
+            'seed': self.seed,
+            'games': self.games,
+            'chunk_size': self.chunk_size,
+            'top': self.top,
+            'games_played': self.games_played,
+            'done_chunks': sorted(self.done_chunks),
+            'histogram': {str(score): count for score, count
+                          in sorted(self.histogram.items())},
+            'best': [{'score': score, 'splitRecord': record, 'chunk': chunk}
+                     for score, record, chunk in self.best],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        state = cls(data['width'], data['height'], data['policy'],
+                    data['seed'], data['games'], data['chunk_size'],
+                    data['top'])
+        state.done_chunks = set(data['done_chunks'])
+        state.histogram = {int(score): count for score, count
+                           in data['histogram'].items()}
+        state.best = [(entry['score'], entry['splitRecord'], entry['chunk'])
+                      for entry in data['best']]
+        return state
+
+    def save(self, path):
+        # Write to a temporary file first, so an interrupted save never
+        # leaves a broken checkpoint behind
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+def run(state, workers=None, checkpoint=None, checkpoint_every=60.0,
+        callback=None):
+    """Play all pending chunks of `state` across a process pool.
+
+    `callback(state, chunk, new_best)` is called in this process after
+    each chunk is merged. If `checkpoint` is a path, the state is saved
+    there at most every `checkpoint_every` seconds, and at the end.
+    """
+    tasks = [(chunk, state.chunk_size_of(chunk), state.width, state.height,
+              state.policy, state.seed, state.top)
+             for chunk in state.pending_chunks()]
+    last_save = time.time()
+    with multiprocessing.Pool(workers) as pool:
+        for chunk, histogram, best in pool.imap_unordered(run_chunk, tasks):
+            new_best = state.add(chunk, histogram, best)
+            if callback is not None:
+                callback(state, chunk, new_best)
+            if checkpoint and time.time() - last_save >= checkpoint_every:
+                state.save(checkpoint)
+                last_save = time.time()
+    if checkpoint:
+        state.save(checkpoint)
+    return state
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Play many SPL-T games to search for high scores.')
+    parser.add_argument('--games', type=int, default=10000)
+    parser.add_argument('--width', type=int, default=8)
+    parser.add_argument('--height', type=int, default=16)
+    parser.add_argument('--policy', default='random',
+                        help='one of {} or module:function'.format(
+                            ', '.join(sorted(POLICIES))))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunk-size', type=int, default=100,
+                        help='games per task handed to a worker')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default: all cores)')
+    parser.add_argument('--top', type=int, default=10,
+                        help='number of best games to keep')
+    parser.add_argument('--checkpoint', default=None,
+                        help='save progress here, and resume from it if it '
+                             'exists')
+    parser.add_argument('--checkpoint-every', type=float, default=60.0,
+                        help='seconds between checkpoints')
+    parser.add_argument('--output', default=None,
+                        help='write the final results here as JSON')
+    args = parser.parse_args(argv)
+
+    get_policy(args.policy)  # Fail early on a bad policy name
+    if args.checkpoint and os.path.exists(args.checkpoint):
+        state = BruteState.load(args.checkpoint)
+        print('Resuming from {}: {} of {} games played'.format(
+            args.checkpoint, state.games_played, state.games))
+    else:
+        state = BruteState(args.width, args.height, args.policy, args.seed,
+                           args.games, args.chunk_size, args.top)
+
+    start = time.time()
+    start_games = state.games_played
+
+    def report(state, chunk, new_best):
+        if new_best:
+            score, record, _ = state.best[0]
+            print('New best score {} after {} games: {}'.format(
+                score, state.games_played, record))
+            sys.stdout.flush()
+
+    run(state, workers=args.workers, checkpoint=args.checkpoint,
+        checkpoint_every=args.checkpoint_every, callback=report)
+
+    elapsed = time.time() - start
+    played = state.games_played - start_games
+    print('Played {} games in {:.1f}s ({:.0f} games/s)'.format(
+        played, elapsed, played / elapsed if elapsed > 0 else 0))
+    for score, record, _ in state.best:
+        print('{}: {}'.format(score, record))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(state.to_dict(), f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""A `gym.Env` that plays on a board hosted by `gym_splt.server`.
+
+The client only needs gym, numpy and the standard library, not the
+simulator, so actors start quickly and stay small:
+
+    env = SpltClientEnv('/tmp/splt.sock')             # Unix socket
+    env = SpltClientEnv(('127.0.0.1', 7777))          # TCP
+    env = gym.make('splt-client-v0', address='/tmp/splt.sock')
+
+Observations, rewards and dones are those of `SpltEnv`, with the action
+mask in `info['action_mask']`. When a step ends the game, no action is
+legal, and the server rejects further steps until `reset` is called.
+"""
+import json
+import socket
+
+import gym
+import numpy as np
+from gym import error, spaces
+
+from gym_splt import protocol
+
+
+class SpltClientEnv(gym.Env):
+    metadata = {'render.modes': []}
+
+    def __init__(self, address='/tmp/splt.sock', timeout=None):
+        if isinstance(address, str):
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self.socket.settimeout(timeout)
+            self.socket.connect(address)
+            self.config = json.loads(self._receive(protocol.CONFIG).decode())
+        except Exception:
+            self.socket.close()
+            raise
+        self.width = self.config['width']
+        self.height = self.config['height']
+        self.n_actions = self.config['n_actions']
+        self.observation_shape = tuple(self.config['observation_shape'])
+        self.observation_size = int(np.prod(self.observation_shape))
+        self.action_space = spaces.Discrete(self.n_actions)
+        self.observation_space = spaces.Box(
+            low=0, high=15, shape=self.observation_shape, dtype=np.uint8)
+        self.state = None
+        self.closed = False
+
+    def step(self, action):
+        self.socket.sendall(protocol.frame(
+            protocol.STEP, protocol.step_request.pack(int(action))))
+        payload = self._receive(protocol.OBSERVATION)
+        reward, done = protocol.step_result.unpack_from(payload)
+        self.state, mask = self._unpack(payload, protocol.step_result.size)
+        return self.state, reward, done, {'action_mask': mask}
+
+    def reset(self):
+        self.socket.sendall(protocol.frame(protocol.RESET))
+        self.state, _ = self._unpack(self._receive(protocol.OBSERVATION))
+        return self.state
+
+    def render(self, mode='human', close=False):
+        raise error.UnsupportedMode(
+            'SpltClientEnv has no render modes, boards live on the server')
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.socket.sendall(protocol.frame(protocol.CLOSE))
+        except OSError:
+            pass  # The server is already gone
+        self.socket.close()
+
+    def _unpack(self, payload, offset=0):
+        """Return the observation and action mask at `offset` of a reply."""
+        state = np.frombuffer(payload, dtype=np.uint8,
+                              count=self.observation_size, offset=offset)
+        mask = np.frombuffer(payload, dtype=bool, count=self.n_actions,
+                             offset=offset + self.observation_size)
+        return state.reshape(self.observation_shape), mask
+
+    def _receive(self, kind):
+        """Read one frame, and return its payload if it is of `kind`."""
+        received_kind, length = protocol.header.unpack(
+            self._read(protocol.header.size))
+        payload = self._read(length)
+        if received_kind == protocol.ERROR:
+            raise RuntimeError('Server error: ' + payload.decode())
+        if received_kind != kind:
+            raise RuntimeError('Expected message kind {} from the server, '
+                               'got {}'.format(kind, received_kind))
+        return payload
+
+    def _read(self, n):
+        buffer = bytearray(n)
+        view = memoryview(buffer)
+        while n:
+            received = self.socket.recv_into(view[-n:], n)
+            if not received:
+                raise ConnectionError('The server closed the connection')
+            n -= received
+        return buffer
@@ -6,9 +6,10 @@ Modifications: Kasper Lauritzen
 
 Simulates a game of SPL-T, one move at a time. Intended to be called from a wrapper script (see playScriptXX examples)
 
-For debugging purposes, you can set the 'verbose' flag to 1. During move executions this will result
+For debugging purposes, you can set the 'verbose' attribute of a board to 1. During move executions this will result
 in a lot of output to the console about the gameboard and the decisions being made, and also a lot
-of 'press any key' pauses.
+of 'press any key' pauses. The module-level 'verbose' and 'startBeingVerboseAfterMoveNumber' settings are only the
+defaults for boards created afterwards; the core never changes them, so boards can be played from several threads.
 
 Example usages:
     # Initialize a board 8 wide x 16 tall
@@ -26,7 +27,12 @@ Example usages:
 """
 
 
+import collections
 import math
+import struct
+import threading
+import time
+import numpy as np
 
 verbose=0
 startBeingVerboseAfterMoveNumber=999999 #If you are only interested in debug information after a certain move
@@ -37,6 +43,66 @@ VERTICAL='|'
 VOID='*'
 NOPOINT=' '
 
+# Codes used for the same symbols in the typed screen buffer (Board.screenGrid). Inside a box the code is simply the
+# number of points, which lines up with NOPOINT (0 points) and VOID (-1 points, i.e. 'just exploded')
+SCREEN_NOPOINT=0
+SCREEN_VOID=-1
+SCREEN_HORIZONTAL=-2
+SCREEN_VERTICAL=-3
+
+screenCodeToSymbol={SCREEN_NOPOINT:NOPOINT, SCREEN_VOID:VOID, SCREEN_HORIZONTAL:HORIZONTAL, SCREEN_VERTICAL:VERTICAL}
+screenSymbolToCode={symbol:code for code,symbol in screenCodeToSymbol.items()}
+
+# If more than this many box outlines changed since the last screen buffer update, redraw everything instead
+maxDirtyRegions=16
+
+# Layout of Board.snapshot(): a header of width, height, splitAction (0 for HORIZONTAL, 1 for VERTICAL), score,
+# number of boxes, length of splitRecord and zobrist, followed by x,y,width,height,points of each box as int32,
+# splitRecord as uint16 and the occupancy index (cellBox) as int16. Everything is little-endian
+snapshotHeader=struct.Struct('<HHBqIIQ')
+snapshotBoxDtype=np.dtype('<i4')
+snapshotRecordDtype=np.dtype('<u2')
+snapshotCellDtype=np.dtype('<i2')
+
+
+# Board.zobrist is the XOR of zobristKey() over all boxes, XORed with zobristVerticalKey when the next split is
+# vertical. It is updated incrementally whenever a box is created, moved, reshaped, re-pointed or destroyed.
+# Every (x,y,width,height,points) gets its own pseudo-random 64-bit key, from a SplitMix64 generator seeded with
+# zobristSeed and the fields themselves, so the keys are the same in every process. They are drawn once and kept
+# in zobristKeys
+zobristSeed=0x5DEECE66D
+zobristMask=(1<<64)-1
+zobristKeys={}
+
+def splitMix64(z):
+    z=(z+0x9E3779B97F4A7C15)&zobristMask
+    z=((z^(z>>30))*0xBF58476D1CE4E5B9)&zobristMask
+    z=((z^(z>>27))*0x94D049BB133111EB)&zobristMask
+    return z^(z>>31)
+
+def zobristKey(x,y,width,height,points):
+    fields=(x,y,width,height,points)
+    key=zobristKeys.get(fields)
+    if key is None:
+        key=zobristSeed
+        for field in fields:
+            key=splitMix64(key^(field&zobristMask))	#points is -1 for a box that just exploded
+        zobristKeys[fields]=key
+    return key
+
+zobristVerticalKey=splitMix64(zobristSeed)
+
+
+# Board.boxAtGeometry is keyed by geometryKey(), which packs an outline into one int: much smaller than a tuple, and
+# the outline shifted by (dx,dy) has the key geometryKey(...)+dx*geometryStrideX+dy*geometryStrideY. Keys are unique
+# as long as boards are less than geometryStride/2 cells in each direction, even for (invalid) negative positions
+geometryStride=4096
+geometryStrideY=geometryStride**2
+geometryStrideX=geometryStride**3
+
+def geometryKey(x,y,width,height):
+    return ((x*geometryStride+y)*geometryStride+width)*geometryStride+height
+
 
 ##########################################
 class Board(object): # Board class represents the gameboard during play.
@@ -45,49 +111,338 @@ class Board(object): # Board class represents the gameboard during play.
     def __init__(self,width=None,height=None,splitRecord=None):
         self.width=width if width is not None else 8
         self.height=height if width is not None else 16
-        self.splitRecord=splitRecord if splitRecord is not None else []
+        self.splitRecord=[]
         self.score=0
         self.box=[]
         self.box.append(Box(0,0,self.width,self.height,0))	#Initialize the board with a single box
         self.splitAction=HORIZONTAL
+        self.zobrist=zobristKey(0,0,self.width,self.height,0)
+
+        # Geometry index for cluster detection: boxAtGeometry[geometryKey(x,y,width,height)] is the box with exactly that outline.
+        # clusterCandidates lists boxes whose outline changed since they were last checked for clusters. Every 2x2 group
+        # of identical no-point boxes contains at least one candidate, so only their neighbourhoods need scanning
+        self.boxAtGeometry={geometryKey(0,0,self.width,self.height):self.box[0]}
+        self.clusterCandidates=[self.box[0]]
+        self.box[0].clusterCandidate=1
 
 
         # Initialize an ascii screen buffer. It's bigger than BoardWidth*BoardHeight because we also want to draw borders
         # This is not just for display to the console! Certain game logic will rely on this
-        self.screenBuffer = [[NOPOINT for x in range((self.width*2)+1)] for x in range(((self.height)*2)+1)]
-
+        # The buffer is stored as integer codes in screenGrid; screenBuffer gives the old [row][column] access to symbols.
+        # Both are only allocated when first used, as boards in a search are rarely drawn
+        self._screenGrid=None
+        self._screenBuffer=None
+        self.drawnBoxes={}	# id(box) -> (box,(x,y,width,height,points)) as of the last screen buffer update
+        self.screenStale=True	# Forces a full redraw on the next update
+
+        # Occupancy index: cellBox[y,x] is the index in box[] of the box covering that cell, or -1 for a void.
+        # It is kept up to date by makeBox, split, moveBox and removeDestroyedBoxes, and box.index always matches
+        # the position of a box in box[]
+        self.cellBox=np.zeros((self.height,self.width),dtype=np.int32)
+
+        # Legal move index: splittable[0][y,x] is True if the box covering cell (x,y) can be split horizontally, and
+        # splittable[1][y,x] if it can be split vertically. It is kept up to date wherever cellBox is, and whenever a box
+        # gains or loses all its points. See legalCells
+        self.splittable=np.zeros((2,self.height,self.width),dtype=bool)
+        self.splittable[0]=self.height>1
+        self.splittable[1]=self.width>1
+
+        # Journals of moves made with makeMove(...,undo=True), most recent last. See undoMove
+        self.undoLog=[]
+
+        # Optional MoveProfiler which makeMove reports to. It may be shared by any number of boards
+        self.profiler=None
+
+        # Debug output for moves on this board. It switches on by itself once verboseAfterMove moves have been made
+        self.verbose=verbose
+        self.verboseAfterMove=startBeingVerboseAfterMoveNumber
+
+        # A board built from a splitRecord starts at the position reached by playing it
+        if splitRecord is not None:
+            self.replay(splitRecord)
+
+
+    @property
+    def screenGrid(self):
+        if self._screenGrid is None:
+            self._screenGrid=np.full(((self.height*2)+1,(self.width*2)+1),SCREEN_NOPOINT,dtype=np.int32)
+            self.drawnBoxes={}
+            self.screenStale=True
+        return self._screenGrid
+
+    @property
+    def screenBuffer(self):
+        if self._screenBuffer is None:
+            self._screenBuffer=ScreenBuffer(self.screenGrid)
+        return self._screenBuffer
 
     def makeBox(self,x,y,width,height,points):
         self.box.append(Box(x,y,width,height,points))
         self.box[-1].index=len(self.box)-1
+        self.cellBox[y:y+height,x:x+width]=len(self.box)-1
+        self.paintSplittable(self.box[-1])
+        self.indexBox(self.box[-1])
+        self.zobrist^=zobristKey(x,y,width,height,points)
+
+    # Moves a box to a new position, keeping the occupancy and geometry indexes and the hash up to date
+    def moveBox(self,box,x,y):
+        self.unindexBox(box)
+        self.cellBox[box.y:box.y+box.height,box.x:box.x+box.width]=-1
+        self.splittable[:,box.y:box.y+box.height,box.x:box.x+box.width]=False
+        self.zobrist^=zobristKey(box.x,box.y,box.width,box.height,box.points)^zobristKey(x,y,box.width,box.height,box.points)
+        box.modify(x,y,box.width,box.height,box.points)
+        self.cellBox[y:y+box.height,x:x+box.width]=box.index
+        self.paintSplittable(box)
+        self.indexBox(box)
+
+    # Changes the points of a box, keeping the hash up to date
+    def setPoints(self,box,points):
+        self.zobrist^=zobristKey(box.x,box.y,box.width,box.height,box.points)^zobristKey(box.x,box.y,box.width,box.height,points)
+        repaint=(box.points==0)!=(points==0)
+        box.points=points
+        if repaint:
+            self.paintSplittable(box)
+
+    # Writes the legal split directions of a box into the legal move index, over the cells it covers
+    def paintSplittable(self,box):
+        cells=self.splittable[:,box.y:box.y+box.height,box.x:box.x+box.width]
+        cells[0]=box.points==0 and box.height>1
+        cells[1]=box.points==0 and box.width>1
+
+    # Returns a (height,width) boolean array which is True where splitting the box covering that cell is a legal move.
+    # It is a view of the legal move index, so it changes as moves are made; copy it to keep it
+    def legalCells(self):
+        return self.splittable[1 if self.splitAction==VERTICAL else 0]
+
+    # Adds a box to the geometry index under its current outline, and marks it for the next cluster scan
+    def indexBox(self,box):
+        self.boxAtGeometry[geometryKey(box.x,box.y,box.width,box.height)]=box
+        if not box.clusterCandidate:
+            box.clusterCandidate=1
+            self.clusterCandidates.append(box)
+
+    def unindexBox(self,box):
+        del self.boxAtGeometry[geometryKey(box.x,box.y,box.width,box.height)]
+
+    # Removes boxes with negative points (destroyed this move) from box[], renumbering the rest.
+    # Returns a list of (index,box) for the removed boxes
+    def removeDestroyedBoxes(self):
+        removed=[(boxindex,box) for boxindex,box in enumerate(self.box) if box.points<0]
+        if len(removed)==0:
+            return removed
+
+        # Compact box[] in place, from the first destroyed box on
+        newIndex=np.arange(len(self.box)+1,dtype=np.int32)	#The extra entry maps void (-1) to void
+        newIndex[-1]=-1
+        boxes=self.box
+        write=removed[0][0]
+        for read in range(write,len(boxes)):
+            box=boxes[read]
+            if box.points<0:
+                self.unindexBox(box)
+                self.splittable[:,box.y:box.y+box.height,box.x:box.x+box.width]=False
+                self.zobrist^=zobristKey(box.x,box.y,box.width,box.height,box.points)
+                newIndex[read]=-1
+            else:
+                newIndex[read]=write
+                box.index=write
+                boxes[write]=box
+                write+=1
+        del boxes[write:]
+        self.cellBox[:]=newIndex[self.cellBox]
+        return removed
+
+    # Column profile of the occupancy index, used for falling and filling:
+
+    # Returns the columns which contain at least one void
+    def columnsWithVoids(self):
+        return np.flatnonzero((self.cellBox<0).any(axis=0)).tolist()
+
+    # Returns, for each column, the number of voids from the top of the board down to the first non-void.
+    # If rows is given, counting also stops at the first row which is not in it
+    def voidDepths(self,rows=None):
+        void=self.cellBox<0
+        if rows is not None:
+            rowMask=np.zeros(self.height,dtype=bool)
+            rowMask[list(rows)]=True
+            void&=rowMask[:,None]
+        return np.where(void.all(axis=0),self.height,void.argmin(axis=0)).tolist()
+
+    # Returns how far a shape covering columns [x,x+width), with its bottom edge just above row y, can fall:
+    # the shortest run of voids below it across those columns
+    def fallDistance(self,x,y,width):
+        if y>=self.height or self.cellBox[y,x]>=0 or (self.cellBox[y,x:x+width]>=0).any():
+            return 0
+        void=self.cellBox[y:,x:x+width]<0
+        return int(np.where(void.all(axis=0),self.height-y,void.argmin(axis=0)).min())
+
+    # Returns the box covering cell (x,y), or None if the cell is a void
+    def boxAt(self,x,y):
+        boxindex=self.cellBox[y,x]
+        if boxindex<0:
+            return None
+        return self.box[boxindex]
+
+    # Plays the moves in splitRecord (box indices, as in Board.splitRecord) from the current position.
+    # Raises ValueError if one of them is not a legal move
+    def replay(self,splitRecord,cache=None):
+        for chosenBox in splitRecord:
+            if not 0<=chosenBox<len(self.box) or not makeMove(self,chosenBox,cache=cache):
+                raise ValueError("Move {0} of the splitRecord (box {1}) is not legal".format(len(self.splitRecord),chosenBox))
+
+    # Rebuilds the occupancy and geometry indexes and the hash from scratch, e.g. after box[] was edited directly
+    def rebuildIndex(self):
+        self.cellBox[:]=-1
+        self.splittable[:]=False
+        self.boxAtGeometry={}
+        self.clusterCandidates=[]
+        for boxindex,box in enumerate(self.box):
+            box.index=boxindex
+            self.cellBox[box.y:box.y+box.height,box.x:box.x+box.width]=boxindex
+            self.paintSplittable(box)
+            box.clusterCandidate=0
+            self.indexBox(box)
+        self.zobrist=self.computeZobrist()
+
+    def computeZobrist(self):
+        zobrist=zobristVerticalKey if self.splitAction==VERTICAL else 0
+        for box in self.box:
+            zobrist^=zobristKey(box.x,box.y,box.width,box.height,box.points)
+        return zobrist
+
+    # Returns the boxes as an (n,5) int32 array with columns x,y,width,height,points, one row per box in box[] order
+    def boxArray(self):
+        return np.array([(box.x,box.y,box.width,box.height,box.points) for box in self.box],dtype=np.int32).reshape(-1,5)
+
+    # Encodes the state of the board (box geometry and points, splitAction, score and splitRecord) as bytes.
+    # The occupancy index and hash are included so that restore() does not have to rebuild them
+    def snapshot(self):
+        if len(self.box)>np.iinfo(snapshotCellDtype).max:
+            raise ValueError("Boards with more than {0} boxes cannot be snapshotted".format(np.iinfo(snapshotCellDtype).max))
+        return (snapshotHeader.pack(self.width,self.height,self.splitAction==VERTICAL,self.score,len(self.box),len(self.splitRecord),self.zobrist)
+            +self.boxArray().astype(snapshotBoxDtype,copy=False).tobytes()
+            +np.array(self.splitRecord,dtype=snapshotRecordDtype).tobytes()
+            +self.cellBox.astype(snapshotCellDtype).tobytes())
+
+    # Returns the board to a state encoded by snapshot(). Existing Box objects, the splitRecord list and the index
+    # arrays are reused rather than reallocated. The occupancy index is copied back in one assignment and the legal
+    # move index is derived from it in one pass, so only the Box objects and the geometry index are built per box
+    def restore(self,snap):
+        width,height,vertical,score,numBoxes,recordLength,zobrist=snapshotHeader.unpack_from(snap)
+        if width!=self.width or height!=self.height:
+            raise ValueError("Snapshot of a {0}x{1} board cannot be restored on a {2}x{3} board".format(width,height,self.width,self.height))
+
+        offset=snapshotHeader.size
+        boxArray=np.frombuffer(snap,dtype=snapshotBoxDtype,count=numBoxes*5,offset=offset).reshape(-1,5)
+        boxData=boxArray.tolist()
+        offset+=numBoxes*5*snapshotBoxDtype.itemsize
+        self.splitRecord[:]=np.frombuffer(snap,dtype=snapshotRecordDtype,count=recordLength,offset=offset).tolist()
+        offset+=recordLength*snapshotRecordDtype.itemsize
+        self.cellBox[:]=np.frombuffer(snap,dtype=snapshotCellDtype,count=width*height,offset=offset).reshape(height,width)
+        self.splitAction=VERTICAL if vertical else HORIZONTAL
+        self.score=score
+        self.zobrist=zobrist
+
+        del self.box[numBoxes:]
+        boxAtGeometry={}
+        for boxindex,(x,y,width,height,points) in enumerate(boxData):
+            if boxindex<len(self.box):
+                box=self.box[boxindex]
+                box.modify(x,y,width,height,points)
+                box.temppoints=0
+                box.halvePointsFlag=0
+                box.fellFlag=0
+            else:
+                box=Box(x,y,width,height,points)
+                self.box.append(box)
+            box.index=boxindex
+            box.clusterCandidate=1
+            boxAtGeometry[geometryKey(x,y,width,height)]=box
+        self.boxAtGeometry=boxAtGeometry
+        self.clusterCandidates=self.box[:]
+        self.paintAllSplittable(boxArray)
+        self.screenStale=True
+        del self.undoLog[:]
+
+    # Rebuilds the whole legal move index from the occupancy index, given the boxes as from boxArray()
+    def paintAllSplittable(self,boxes):
+        noPoints=np.append(boxes[:,4]==0,False)	#The extra entry is picked up by voids (-1)
+        np.take(noPoints&np.append(boxes[:,3]>1,False),self.cellBox,out=self.splittable[0])
+        np.take(noPoints&np.append(boxes[:,2]>1,False),self.cellBox,out=self.splittable[1])
+
+    # Finds every 2x2 group of identical no-point boxes which includes a cluster candidate, looking only at the
+    # neighbourhood of each candidate. If width and height are given, only candidates of that size are considered.
+    # The candidates that were looked at are no longer candidates afterwards.
+    # Returns a list of groups, each a list of four boxes with the upper left one first
+    def findClusters(self,width=None,height=None):
+        clusters=[]
+        remainingCandidates=[]
+        for box in self.clusterCandidates:
+            if width is not None and (box.width!=width or box.height!=height):
+                remainingCandidates.append(box)
+                continue
+            box.clusterCandidate=0
+            if box.points!=0:	#Point blocks never go back to zero points, and destroyed blocks are gone
+                continue
+
+            key=geometryKey(box.x,box.y,box.width,box.height)
+            dx=box.width*geometryStrideX
+            dy=box.height*geometryStrideY
+            # The candidate could be in any of the four corners of a group
+            for corner in (key,key-dx,key-dy,key-dx-dy):
+                group=[]
+                for offset in (0,dx,dx+dy,dy):
+                    member=self.boxAtGeometry.get(corner+offset)
+                    if member is None or member.points!=0:
+                        break
+                    group.append(member)
+                if len(group)==4:
+                    clusters.append(group)
+        self.clusterCandidates=remainingCandidates
+        return clusters
 
     # Equality check at the gameBoard level is more than just a simple list compare of each board's box[] list, because the box ordering in the lists may differ.
-    # We also can't use the box class equality check, since that one ignores position on the board
+    # We also can't use the box class equality check, since that one ignores position on the board.
+    # Two boards are equal if they hold the same boxes (position, size and points) and the next split has the same direction.
+    # Boxes never overlap, so comparing them as sets is enough, and the hashes rule out most unequal boards up front
     def __eq__(self, other):
-        duplicateScore=0
-        for b1 in self.box:
-            for b2 in other.box:
-                if (b1.x==b2.x) and (b1.y==b2.y) and (b1.width==b2.width) and (b1.height==b2.height) and (b1.points==b2.points):
-                    duplicateScore+=1
+        if self.zobrist!=other.zobrist or self.splitAction!=other.splitAction or len(self.box)!=len(other.box):
+            return False
+        return set((box.x,box.y,box.width,box.height,box.points) for box in self.box)==set((box.x,box.y,box.width,box.height,box.points) for box in other.box)
 
-        if duplicateScore==len(self.box): #If the number of duplicates is the same as the number of boxes
-            return 1
-        else:
-            return 0
+    # Boards are mutable, so only use them as dict keys while they are not being played on
+    def __hash__(self):
+        return self.zobrist
 
     def split(self,box):
         if box.splitPossible(self.splitAction)==0:
-            if verbose: print("Impossible split requested")
+            if self.verbose: print("Impossible split requested")
             return 0
 
+        self.unindexBox(box)
+        self.zobrist^=zobristKey(box.x,box.y,box.width,box.height,box.points)^zobristVerticalKey
+        # Halving an odd size leaves a strip along the far edge uncovered, which becomes a void
+        if self.splitAction==VERTICAL and box.width%2==1:
+            self.cellBox[box.y:box.y+box.height,box.x+box.width-1]=-1
+            self.splittable[:,box.y:box.y+box.height,box.x+box.width-1]=False
+        elif self.splitAction==HORIZONTAL and box.height%2==1:
+            self.cellBox[box.y+box.height-1,box.x:box.x+box.width]=-1
+            self.splittable[:,box.y+box.height-1,box.x:box.x+box.width]=False
+
         if self.splitAction==VERTICAL:
             box.modify(box.x,box.y,box.width//2,box.height,0)
+            self.paintSplittable(box)
+            self.indexBox(box)
+            self.zobrist^=zobristKey(box.x,box.y,box.width,box.height,0)
             self.makeBox(box.x+box.width,box.y,box.width,box.height,0)
             self.splitAction=HORIZONTAL
             return 1
 
         if self.splitAction==HORIZONTAL:
             box.modify(box.x,box.y,box.width,box.height//2,0)
+            self.paintSplittable(box)
+            self.indexBox(box)
+            self.zobrist^=zobristKey(box.x,box.y,box.width,box.height,0)
             self.makeBox(box.x,box.y+box.height,box.width,box.height,0)
             self.splitAction=VERTICAL
             return 1
@@ -97,7 +452,7 @@ class Board(object): # Board class represents the gameboard during play.
         for boxindex,box in enumerate(self.box):
             if box.splitPossible(self.splitAction):
                 moveOptions.append(boxindex)
-        if verbose and len(moveOptions)==0:	print("---> No valid moves available! <---")
+        if self.verbose and len(moveOptions)==0:	print("---> No valid moves available! <---")
         return moveOptions
 
 
@@ -105,6 +460,11 @@ class Board(object): # Board class represents the gameboard during play.
 class Box(object): # Box class represents individual boxes within a gameboard
 ##########################################
 
+    # Boards are held by the hundred thousand during search, so boxes have no __dict__. They stay objects rather than
+    # rows of a table, as makeMove keeps references to them from one phase to the next. Positions held in bulk are
+    # better kept as snapshots (see Board.snapshot), about 1 KB on an 8x16 board against 10 KB for a live Board
+    __slots__=('x','y','width','height','points','index','temppoints','halvePointsFlag','fellFlag','clusterCandidate')
+
     def __init__(self,x,y,width,height,points):
         self.x=x
         self.y=y 	#y axis points towards the floor, so 0 is the top of the board
@@ -119,6 +479,8 @@ class Box(object): # Box class represents individual boxes within a gameboard
         self.halvePointsFlag=0
         self.fellFlag=0
 
+        self.clusterCandidate=0	# Set while the box is in its board's clusterCandidates list
+
     def __eq__(self, other):
         if self.width==other.width and self.height==other.height and self.points==other.points:
             return True
@@ -144,44 +506,341 @@ class Box(object): # Box class represents individual boxes within a gameboard
 
 
 
+##########################################
+class MoveJournal(object): # Records what a single call to makeMove changed, so that undoMove can revert it
+##########################################
+
+    def __init__(self,gameBoard):
+        self.splitAction=gameBoard.splitAction
+        self.score=gameBoard.score
+        self.zobrist=gameBoard.zobrist
+        self.clusterCandidates=list(gameBoard.clusterCandidates)
+        self.touched={}		# id(box) -> (box,x,y,width,height,points) from before the box was first changed
+        self.removed=[]		# (index,box) for destroyed boxes, as returned by Board.removeDestroyedBoxes
+        self.splitBox=None	# The box created by the split
+        self.numFilled=0	# Number of boxes created by filling, at the end of box[]
+
+    # Call before changing the geometry or points of a box
+    def touch(self,box):
+        if id(box) not in self.touched:
+            self.touched[id(box)]=(box,box.x,box.y,box.width,box.height,box.points)
+
+
+##########################################
+class MoveProfiler(object): # Wall time and event counts for each phase of makeMove, for boards which have it as profiler
+##########################################
+    #
+    # times[phase] is the total time spent in a phase, in seconds, and counts[name] the number of times something
+    # happened. Profilers from different boards, envs or processes can be combined with merge, and pickle as usual.
+    # A profiler can be shared by boards played in different threads: the time of the last lap is kept per thread
+
+    phases=('split','clusterScan','countdown','destruction','falling','filling','recluster','halving','cachedMove','screenUpdate')
+
+    def __init__(self):
+        self.times=collections.Counter()
+        self.counts=collections.Counter()
+        self.lock=threading.Lock()
+        self.clock=threading.local()	# clock.lastTime is the time of the last start or lap in this thread
+
+    def __getstate__(self):
+        with self.lock:
+            return {'times':self.times.copy(),'counts':self.counts.copy()}
+
+    def __setstate__(self,state):
+        self.__init__()
+        self.times.update(state['times'])
+        self.counts.update(state['counts'])
+
+    def start(self):
+        self.clock.lastTime=time.perf_counter()
+
+    # Adds the time since the last call to start or lap in this thread to a phase
+    def lap(self,phase):
+        now=time.perf_counter()
+        with self.lock:
+            self.times[phase]+=now-self.clock.lastTime
+        self.clock.lastTime=now
+
+    def count(self,name,number=1):
+        with self.lock:
+            self.counts[name]+=number
+
+    def merge(self,other):
+        state=other.__getstate__()
+        with self.lock:
+            self.times.update(state['times'])
+            self.counts.update(state['counts'])
+        return self
+
+    def reset(self):
+        with self.lock:
+            self.times.clear()
+            self.counts.clear()
+
+    def summary(self):
+        lines=[]
+        state=self.__getstate__()
+        times,counts=state['times'],state['counts']
+        total=sum(times.values())
+        for phase in sorted(times,key=lambda phase:self.phases.index(phase) if phase in self.phases else len(self.phases)):
+            lines.append("{0:>24} {1:10.4f} s {2:6.1%}".format(phase,times[phase],times[phase]/total if total else 0))
+        for name in sorted(counts):
+            lines.append("{0:>24} {1:10d}".format(name,counts[name]))
+        return "\n".join(lines)
+
+
+##########################################
+class TransitionCache(object): # Bounded LRU cache of move outcomes, shared by any number of boards
+##########################################
+    #
+    # Entries are keyed on the board hash, the number of moves made so far (new clusters get points based on it) and
+    # the outline of the box being split, so boards which reached the same position in a different way share entries.
+    # An entry holds the boxes changed by the move, the boxes it created, the new splitAction and hash, and the score
+    # gained. Applying it gives exactly the board makeMove would produce. Boxes are kept as packed int32 rows, since
+    # a dict of every box per entry took around 10 KB on 8x16 boards and 40 KB on 16x32, and a move changes only a
+    # few of them: (old x,y,width,height, new x,y,width,height,points) for each box which was changed, with points -1
+    # for a destroyed box, and (x,y,width,height,points) for each new box. Unchanged boxes are not stored
+    # Entries are never changed once stored, so only the lookups and stores are done under the lock, and boards in
+    # different threads can share a cache
+
+    def __init__(self,maxSize=100000):
+        self.maxSize=maxSize
+        self.entries=collections.OrderedDict()
+        self.hits=0
+        self.misses=0
+        self.lock=threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits=0
+            self.misses=0
+
+    def makeMove(self,gameBoard,chosenBox):
+        box=gameBoard.box[chosenBox]
+        if box.splitPossible(gameBoard.splitAction)==0:
+            return makeMove(gameBoard,chosenBox)
+
+        key=(gameBoard.width,gameBoard.height,gameBoard.zobrist,len(gameBoard.splitRecord),box.x,box.y,box.width,box.height)
+        with self.lock:
+            outcome=self.entries.get(key)
+            if outcome is not None:
+                self.hits+=1
+                self.entries.move_to_end(key)
+            else:
+                self.misses+=1
+        if outcome is not None:
+            profiler=gameBoard.profiler
+            if profiler is not None: profiler.start()
+            applyTransition(gameBoard,chosenBox,outcome)
+            if profiler is not None:
+                profiler.lap('cachedMove')
+                profiler.count('moves')
+                profiler.count('cacheHits')
+            return True
+
+        if gameBoard.profiler is not None: gameBoard.profiler.count('cacheMisses')
+        before=[(box,(box.x,box.y,box.width,box.height,box.points)) for box in gameBoard.box]
+        score=gameBoard.score
+        makeMove(gameBoard,chosenBox)
+
+        changed=[]
+        survivors=0
+        for box,fields in before:
+            if box.points<0:
+                changed.extend(fields[:4]+(-1,-1,-1,-1,-1))
+            else:
+                survivors+=1
+                if (box.x,box.y,box.width,box.height,box.points)!=fields:
+                    changed.extend(fields[:4]+(box.x,box.y,box.width,box.height,box.points))
+        created=[]
+        for box in gameBoard.box[survivors:]:
+            created.extend((box.x,box.y,box.width,box.height,box.points))
+        outcome=(np.array(changed,dtype=np.int32).tobytes(),np.array(created,dtype=np.int32).tobytes(),
+                 gameBoard.splitAction,gameBoard.zobrist,gameBoard.score-score)
+        with self.lock:
+            self.entries[key]=outcome
+            if len(self.entries)>self.maxSize:
+                self.entries.popitem(last=False)
+        return True
+
+
+# Applies a move outcome from a TransitionCache to gameBoard, as if makeMove(gameBoard,chosenBox) had been called
+##########################################
+def applyTransition(gameBoard,chosenBox,outcome):
+##########################################
+    changed,created,splitAction,zobrist,scoreGain=outcome
+    changes={}
+    for row in np.frombuffer(changed,dtype=np.int32).reshape(-1,9).tolist():
+        changes[tuple(row[:4])]=tuple(row[4:])
+    reshaped=[]
+
+    # Clear every box that moves out of the indexes before putting any back, since they may swap cells
+    for box in gameBoard.box:
+        fields=changes.get((box.x,box.y,box.width,box.height))
+        if fields is None:
+            continue	#Unchanged
+        elif fields[4]<0:
+            box.points=-1	#Destroyed, removeDestroyedBoxes takes care of it
+        elif fields[:4]!=(box.x,box.y,box.width,box.height):
+            gameBoard.cellBox[box.y:box.y+box.height,box.x:box.x+box.width]=-1
+            gameBoard.splittable[:,box.y:box.y+box.height,box.x:box.x+box.width]=False
+            gameBoard.unindexBox(box)
+            reshaped.append((box,fields))
+        elif fields[4]!=box.points:
+            repaint=(box.points==0)!=(fields[4]==0)
+            box.points=fields[4]
+            if repaint:
+                gameBoard.paintSplittable(box)
+    gameBoard.removeDestroyedBoxes()
+
+    for box,fields in reshaped:
+        box.modify(*fields)
+        gameBoard.cellBox[box.y:box.y+box.height,box.x:box.x+box.width]=box.index
+        gameBoard.paintSplittable(box)
+        gameBoard.indexBox(box)
+    for fields in np.frombuffer(created,dtype=np.int32).reshape(-1,5).tolist():
+        gameBoard.makeBox(*fields)
+
+    gameBoard.splitAction=splitAction
+    gameBoard.zobrist=zobrist
+    gameBoard.score+=scoreGain
+    gameBoard.splitRecord.append(chosenBox)
+
+
+##########################################
+class ScreenBuffer(object): # List-of-lists style access to the symbols in a board's screenGrid
+##########################################
+
+    def __init__(self,grid):
+        self.grid=grid
+
+    def __getitem__(self,row):
+        return ScreenBufferRow(self.grid[row])
+
+    def __len__(self):
+        return len(self.grid)
+
+    def __iter__(self):
+        for row in range(len(self.grid)):
+            yield ScreenBufferRow(self.grid[row])
+
+    def __array__(self,dtype=None,copy=None):
+        return np.array([list(row) for row in self],dtype=dtype)
+
+
+class ScreenBufferRow(object):
+
+    def __init__(self,row):
+        self.row=row
+
+    def __getitem__(self,column):
+        if isinstance(column,slice):
+            return [screenCodeToSymbol.get(code,code) for code in self.row[column].tolist()]
+        code=int(self.row[column])
+        return screenCodeToSymbol.get(code,code)
+
+    def __setitem__(self,column,value):
+        self.row[column]=screenSymbolToCode.get(value,value)
+
+    def __len__(self):
+        return len(self.row)
+
+    def __iter__(self):
+        for code in self.row.tolist():
+            yield screenCodeToSymbol.get(code,code)
+
+    def __eq__(self,other):
+        return list(self)==list(other)
+
+
 
 # updateScreenBuffer updates the ascii representation of the input gameboard. This is used for both
 # decision making as well as drawing the gameboard in the console when debugging.
+#
+# Only the regions covered by boxes which were created, moved, resized, destroyed or had their points changed since the
+# previous update are redrawn. Boxes are always drawn in list order (later boxes overwrite the shared outlines of earlier
+# ones), and redraws are clipped to the changed region so the result is identical to redrawing everything.
 ##########################################
 def updateScreenBuffer(gameBoard):
 ##########################################
-    for ii in range((gameBoard.width*2)+1):
-        for jj in range((gameBoard.height*2)+1):
-            gameBoard.screenBuffer[jj][ii]=NOPOINT
-
-    for ii in range(gameBoard.width):
-        for jj in range(gameBoard.height):
-            gameBoard.screenBuffer[(jj*2)+1][(ii*2)+1]=VOID
-
-    #for all boxes
-    for boxindex,box in enumerate(gameBoard.box):
-        #Draw the top and bottom lines
-        for ii in range((box.width*2)+1):
-            gameBoard.screenBuffer[box.y*2][(box.x*2)+ii]=HORIZONTAL
-            gameBoard.screenBuffer[(box.y*2)+(box.height*2)][(box.x*2)+ii]=HORIZONTAL
-
-        #Draw the sides
-        for ii in range((box.height*2)+1):
-            gameBoard.screenBuffer[(box.y*2)+ii][(box.x*2)]=VERTICAL
-            gameBoard.screenBuffer[(box.y*2)+ii][(box.x*2)+(box.width*2)]=VERTICAL
-
-        #Draw the nature of the space: void, no-point block or point block
-        for jj in range(box.height):
-            for ii in range(box.width):
-                if box.points==-1:
-                    gameBoard.screenBuffer[((box.y+jj)*2)+1][((box.x+ii)*2)+1]=VOID
-
-                elif box.points==0:
-                    gameBoard.screenBuffer[((box.y+jj)*2)+1][((box.x+ii)*2)+1]=NOPOINT
+    profiler=gameBoard.profiler
+    if profiler is not None: profiler.start()
+    grid=gameBoard.screenGrid
+    drawnBoxes=gameBoard.drawnBoxes
+    currentBoxes={}
+    dirtyRegions=[]
 
-                else:
-                    gameBoard.screenBuffer[((box.y+jj)*2)+1][((box.x+ii)*2)+1] = box.points
-                    # TODO: This could be box.points instead
+    for box in gameBoard.box:
+        geometry=(box.x,box.y,box.width,box.height,box.points)
+        currentBoxes[id(box)]=(box,geometry)
+        drawn=drawnBoxes.pop(id(box),None)
+        if drawn is None:
+            dirtyRegions.append(geometry)
+        elif drawn[1]!=geometry:
+            dirtyRegions.append(drawn[1])
+            dirtyRegions.append(geometry)
+    for box,geometry in drawnBoxes.values():	#Whatever is left has been removed from the board
+        dirtyRegions.append(geometry)
+    gameBoard.drawnBoxes=currentBoxes
+
+    if gameBoard.screenStale or len(dirtyRegions)>maxDirtyRegions:
+        gameBoard.screenStale=False
+        dirtyRegions=[(0,0,gameBoard.width,gameBoard.height,0)]
+        if profiler is not None: profiler.count('screenFullRedraws')
+    if profiler is not None: profiler.count('screenRegionRedraws',len(dirtyRegions))
+
+    for x,y,width,height,points in dirtyRegions:
+        top,bottom,left,right=y*2,(y+height)*2+1,x*2,(x+width)*2+1
+        #Clear the region: no walls, and void everywhere until a box is drawn on top
+        grid[top:bottom,left:right]=SCREEN_NOPOINT
+        grid[top+1:bottom:2,left+1:right:2]=SCREEN_VOID
+
+        for box in gameBoard.box:
+            if box.y*2<bottom and (box.y+box.height)*2>=top and box.x*2<right and (box.x+box.width)*2>=left:
+                drawBox(grid,box,top,bottom,left,right)
+
+    if profiler is not None: profiler.lap('screenUpdate')
+
+
+# drawBox draws the outline and contents of a single box into a typed screen buffer, clipped to
+# rows [top,bottom) and columns [left,right)
+##########################################
+def drawBox(grid,box,top,bottom,left,right):
+##########################################
+    boxTop,boxBottom=box.y*2,(box.y+box.height)*2
+    boxLeft,boxRight=box.x*2,(box.x+box.width)*2
+
+    #Draw the top and bottom lines
+    columns=clipRange(boxLeft,boxRight+1,1,left,right)
+    if columns is not None:
+        if top<=boxTop<bottom: grid[boxTop,columns]=SCREEN_HORIZONTAL
+        if top<=boxBottom<bottom: grid[boxBottom,columns]=SCREEN_HORIZONTAL
+
+    #Draw the sides
+    rows=clipRange(boxTop,boxBottom+1,1,top,bottom)
+    if rows is not None:
+        if left<=boxLeft<right: grid[rows,boxLeft]=SCREEN_VERTICAL
+        if left<=boxRight<right: grid[rows,boxRight]=SCREEN_VERTICAL
+
+    #Draw the nature of the space: void, no-point block or point block
+    rows=clipRange(boxTop+1,boxBottom,2,top,bottom)
+    columns=clipRange(boxLeft+1,boxRight,2,left,right)
+    if rows is not None and columns is not None:
+        grid[rows,columns]=box.points
+
+
+# Intersects range(start,stop,step) with [low,high), as a slice. Returns None if the intersection is empty
+def clipRange(start,stop,step,low,high):
+    if start<low:
+        start+=-(-(low-start)//step)*step
+    stop=min(stop,high)
+    if start>=stop:
+        return None
+    return slice(start,stop,step)
 
 
 
@@ -191,16 +850,18 @@ def updateScreenBuffer(gameBoard):
 ##########################################
 def drawScreen(gameBoard):
 ##########################################
+    print(screenText(gameBoard),end='')
+
+# screenText returns what drawScreen prints, as a single string. Every symbol is right aligned to the width of the
+# longest points value, and each row ends with a newline. The grid is translated symbol by symbol rather than cell by cell
+def screenText(gameBoard):
     updateScreenBuffer(gameBoard)
-    max_length_points = get_max_digits_points(gameBoard)
-    for jj in range((gameBoard.height*2)+1):
-        for ii in range((gameBoard.width*2)+1):
-            value = gameBoard.screenBuffer[jj][ii]
-            if isinstance(value, int):
-                value = str(value)
-            value = ' ' * (max_length_points - len(value)) + value
-            print(value, end='')
-        print('\n', end='')
+    grid=gameBoard.screenGrid
+    max_length_points=get_max_digits_points(gameBoard)
+    codes,inverse=np.unique(grid,return_inverse=True)
+    symbols=np.array([str(screenCodeToSymbol.get(code,code)).rjust(max_length_points) for code in codes.tolist()],dtype=object)
+    rows=symbols[inverse.reshape(grid.shape)]
+    return ''.join(''.join(row)+'\n' for row in rows.tolist())
 
 def get_max_digits_points(game_board):
     max_digits = 1
@@ -210,11 +871,20 @@ def get_max_digits_points(game_board):
             max_digits = digits
     return max_digits
 # Evolves an input gameBoard forward, given that you are choosing to split chosenBox on that gameBoard
+#
+# If undo is set, a journal of the changes is pushed to gameBoard.undoLog, and undoMove(gameBoard) will revert the move.
+# If cache is given (see TransitionCache), the outcome is looked up there first, and stored there if it was not found
 ##########################################
-def makeMove(gameBoard,chosenBox):
+def makeMove(gameBoard,chosenBox,undo=False,cache=None):
 ##########################################
 
-    global verbose
+    if cache is not None and not undo:
+        return cache.makeMove(gameBoard,chosenBox)
+
+    journal=MoveJournal(gameBoard) if undo else None
+    verbose=gameBoard.verbose
+    profiler=gameBoard.profiler
+    if profiler is not None: profiler.start()
 
     # -------- 1. Try to execute the split: -------------------------------------------------------------------------------------
     #
@@ -222,14 +892,22 @@ def makeMove(gameBoard,chosenBox):
         print("\n\n**************** Start of move ****************")
         drawScreen(gameBoard)
         print("-------- 1. Try to execute the split")
+    if journal is not None: journal.touch(gameBoard.box[chosenBox])
     if gameBoard.split(gameBoard.box[chosenBox])==0:
         #print("Problem trying to split box {0}, aborting".format(chosenBox))
+        if profiler is not None:
+            profiler.lap('split')
+            profiler.count('illegalMoves')
         return False
+    if profiler is not None:
+        profiler.lap('split')
+        profiler.count('moves')
 
     gameBoard.splitRecord.append(chosenBox)
+    if journal is not None: journal.splitBox=gameBoard.box[-1]
 
-    if len(gameBoard.splitRecord)>=startBeingVerboseAfterMoveNumber:
-        verbose=1
+    if len(gameBoard.splitRecord)>=gameBoard.verboseAfterMove:
+        gameBoard.verbose=verbose=1
 
 
 
@@ -237,56 +915,45 @@ def makeMove(gameBoard,chosenBox):
     # -------- 2. Determine whether four or more similar boxes are now adjacent   -----------------------------------------------
     #
     # Algorithm:
-    # 	Scan through all boxes, for each check whether it is in the upper left hand corner of a set of at least 4 identical boxes
+    # 	For each cluster candidate (see Board.findClusters), look up whether it is in any corner of a set of at least 4
+    # 	identical boxes. The neighbours are found in the geometry index, keyed by (x,y,width,height)
     #
     # 	If there is a set of 6, it will register twice: once as the correct set of 6 plus another again as a subset of 4
     # 	This doesn't matter beyond efficiency concerns! The end effect is still correct
 
     # 	Optimization: The only clusters that could have formed at this stage involve the box you just split
-    # 	So while scanning through the boxes, only subscan boxes which are the same size (box equality method compares size)
+    # 	So only candidates which are the same size as the boxes from the split are looked at
 
     if verbose:
         drawScreen(gameBoard)
         print("\n-------- 2. Look for new clusters\n")
 
     lastCreatedBox=gameBoard.box[-1]
+    clusterMembers=[]
+    if profiler is not None: profiler.count('clusterCandidatesScanned',len(gameBoard.clusterCandidates))
 
-    for box in gameBoard.box:
-
-        if box.points==0:
-            if box==lastCreatedBox:	#See optimization note above
-
-                setMembers=[] #A list of identical neighbours for this box
+    for group in gameBoard.findClusters(lastCreatedBox.width,lastCreatedBox.height):	#See optimization note above
 
-                for otherboxindex,otherbox in enumerate(gameBoard.box):
-                    if otherbox.points==0:
-                        if box==otherbox:	#Equality method compares width, height and number of points.
-                            # If otherbox is beside box
-                            if otherbox.x==(box.x+box.width) and otherbox.y==box.y:	setMembers.append(otherboxindex)
-                            # If otherbox is diagonal to box
-                            elif otherbox.x==(box.x+box.width) and otherbox.y==(box.y+box.height):	setMembers.append(otherboxindex)
-                            # If otherbox is below box
-                            elif otherbox.x==box.x and otherbox.y==(box.y+box.height):	setMembers.append(otherboxindex)
+        # We found a set of four, and group[0] is the one in the upper left
+        # So we should assign points to the whole set
+        # For now we just make a note to assign these points, but don't actually do it until the end of the scan.
+        # Otherwise we'll mess up the ongoing scan e.g. if you find a group of 4 and immediately make them point
+        # blocks, you will not notice if they are actually part of 6+ block cluster
+        for box in group:
+            box.temppoints=len(gameBoard.splitRecord)+1
+        clusterMembers.extend(group)
 
-                if len(setMembers)==3:
-
-                    # We found a set of four, and {box} is the one in the upper left
-                    # So we should assign points to the whole set
-                    # For now we just make a note to assign these points, but don't actually do it until the end of the scan.
-                    # Otherwise we'll mess up the ongoing scan e.g. if you find a group of 4 and immediately make them point
-                    # blocks, you will not notice if they are actually part of 6+ block cluster
-                    box.temppoints=len(gameBoard.splitRecord)+1
-                    gameBoard.box[setMembers[0]].temppoints=len(gameBoard.splitRecord)+1
-                    gameBoard.box[setMembers[1]].temppoints=len(gameBoard.splitRecord)+1
-                    gameBoard.box[setMembers[2]].temppoints=len(gameBoard.splitRecord)+1
-
-                    if verbose:	print("\t Found a cluster")
+        if verbose:	print("\t Found a cluster")
 
     # Once the cluster scanning is complete, assign points to any boxes which were found to be in new clusters
-    for box in gameBoard.box:
+    for box in clusterMembers:
         if box.temppoints>0:
-            box.points+=box.temppoints
+            if journal is not None: journal.touch(box)
+            gameBoard.setPoints(box,box.points+box.temppoints)
             box.temppoints=0
+    if profiler is not None:
+        profiler.lap('clusterScan')
+        profiler.count('clusterBoxes',len(clusterMembers))
 
 
 
@@ -298,7 +965,15 @@ def makeMove(gameBoard,chosenBox):
 
     countDownScore=0	# Keep track of this for point allocation at the end of the turn
 
+    zobrist=gameBoard.zobrist	#setPoints inlined, as this touches every point block on every move
+
     for box in gameBoard.box:
+        if box.points<=0:
+            continue
+        if journal is not None: journal.touch(box)
+
+        fields=(box.x,box.y,box.width,box.height,box.points)
+        zobrist^=zobristKeys.get(fields) or zobristKey(*fields)
         if box.points>1:
             box.points-=1
             countDownScore+=1
@@ -306,8 +981,13 @@ def makeMove(gameBoard,chosenBox):
         elif box.points==1:
             box.points=-1 #-1 is a special value to denote 'just exploded'
             countDownScore+=1
-        else:
-            pass
+        fields=(box.x,box.y,box.width,box.height,box.points)
+        zobrist^=zobristKeys.get(fields) or zobristKey(*fields)
+
+    gameBoard.zobrist=zobrist
+    if profiler is not None:
+        profiler.lap('countdown')
+        profiler.count('pointBlocksCounted',countDownScore)
 
 
 
@@ -326,7 +1006,12 @@ def makeMove(gameBoard,chosenBox):
                 for ii in range(box.y,box.y+box.height):
                     if not ii in rowsWithDestruction: rowsWithDestruction.append(ii)
     #Remove the boxes from gameBoard.box[]
-    gameBoard.box[:] = [box for box in gameBoard.box if box.points>=0]
+    removedBoxes=gameBoard.removeDestroyedBoxes()
+    if journal is not None: journal.removed=removedBoxes
+    numBoxesBeforeFilling=len(gameBoard.box)
+    if profiler is not None:
+        profiler.lap('destruction')
+        profiler.count('boxesDestroyed',len(removedBoxes))
 
 
 
@@ -348,17 +1033,10 @@ def makeMove(gameBoard,chosenBox):
         print("\n-------- 5. Process falling\n")
         drawScreen(gameBoard)
 
-    updateScreenBuffer(gameBoard)
-
     columnsWithFalling=[]
 
     #Optimization: first figure out which columns have voids. We can then cheaply check whether a box is eligible for falling
-    columnsWithVoids=[]
-
-    for ii in range(gameBoard.width):
-        for jj in range(gameBoard.height):
-            if gameBoard.screenBuffer[((jj)*2)+1][((ii)*2)+1] ==VOID:
-                if not ii in columnsWithVoids: columnsWithVoids.append(ii)
+    columnsWithVoids=set(gameBoard.columnsWithVoids())
 
 
     fallingHappened=False
@@ -378,41 +1056,22 @@ def makeMove(gameBoard,chosenBox):
 
             else:
                 # We want to know if every tile in contact with the bottom edge of this box is void, and to what
-                # depth that is true. An easy way to do it is by looking at the ascii screen buffer
-
-                distanceToFall=9999 #assume the box will fall a long way, then adjust it down to the true value
+                # depth that is true. The occupancy index answers that for all columns of the box at once
 
-                for ii in range(box.width):
-
-                    stopFound=False
-                    jj=0	# jj= number of voids below the ii'th column of this box
-                    while stopFound==False:
-                        if box.y+box.height+jj<gameBoard.height:
-                            if gameBoard.screenBuffer[((box.y+jj+box.height)*2)+1][((box.x+ii)*2)+1] !=VOID:
-                                stopFound=True
-                            else:
-                                jj+=1
-                        else:
-                            stopFound=True
-
-                    if jj<distanceToFall:
-                        distanceToFall=jj
-
-                    if jj==0:	#If any column of the box has no voids below it, it can't fall so we can stop immediately.
-                        break
+                distanceToFall=gameBoard.fallDistance(box.x,box.y+box.height,box.width)
 
                 # If falling needs to happen, do it
                 if distanceToFall>0:
                     if verbose: print("\tBox {0} at ({1},{2}) should fall a distance of {3}".format(boxindex,box.x,box.y,distanceToFall))
-                    box.modify(box.x,box.y+distanceToFall,box.width,box.height,box.points)
+                    if journal is not None: journal.touch(box)
+                    gameBoard.moveBox(box,box.x,box.y+distanceToFall)
                     if box.points>0: box.fellFlag=1 	#Make a note to halve the points later - it's too soon to do it now
                     fallingHappened=True
+                    if profiler is not None: profiler.count('falls')
 
                     for ii in range(box.x,box.x+box.width):
                         if not ii in columnsWithFalling: columnsWithFalling.append(ii)
 
-                    updateScreenBuffer(gameBoard)
-
                     movementScanRequired=True 	#Setting this flag causes the parent loop to run through all blocks one more time
 
                 # else this box should not fall
@@ -420,6 +1079,7 @@ def makeMove(gameBoard,chosenBox):
                     pass
 
     columnsWithFalling.sort()
+    if profiler is not None: profiler.lap('falling')
 
     # -------- 6. Process new blocks coming in from the top ---------------------------------------------------------------------
     #
@@ -433,8 +1093,6 @@ def makeMove(gameBoard,chosenBox):
     # There is some strangeness here: pre-existing voids are never filled, unless a block has fallen through it.
     # For this reason we kept track of 'columnsWithFalling'
 
-    updateScreenBuffer(gameBoard)
-    voidCount=0
     numVoids=[] #If for example the gameboard has a 2x2 pocket in the upper left corner, numVoids will be [2,2,0,0,0,0,0,0]
 
     if verbose:
@@ -444,37 +1102,12 @@ def makeMove(gameBoard,chosenBox):
 
         if verbose: print("\tNo falling happened, but block destruction did. Exclude pre-exisiting voids")
 
-        for column in range(gameBoard.width):	#For each column on the game board
-            row=0 				#Start scanning down the rows starting at zero (top of the board)
-            stopRowScan=False
-
-            while stopRowScan==False:
-                if gameBoard.screenBuffer[(row*2)+1][(column*2)+1] == VOID and row in rowsWithDestruction: voidCount+=1
-                else: stopRowScan=True # As soon as you hit a non-void, you're done with this column
-
-                row+=1
-
-                # If you get to the bottom of the game board, you're done. -1 because we count rows from zero
-                if row>(gameBoard.height-1): stopRowScan=True
-
-            numVoids.append(voidCount)
-            voidCount=0
+        # For each column, count the voids from the top of the board down, stopping as soon as you hit a non-void
+        # or a row where nothing was destroyed
+        numVoids=gameBoard.voidDepths(rowsWithDestruction)
     else:
-        for column in range(gameBoard.width):
-            row=0 				#Start scanning down the rows starting at zero (top of the board)
-            stopRowScan=False
-
-            while stopRowScan==False:
-                if gameBoard.screenBuffer[(row*2)+1][(column*2)+1] == VOID: voidCount+=1
-                else: stopRowScan=True # As soon as you hit a non-void, you're done with this column
-
-                row+=1
-
-                # If you get to the bottom of the game board, you're done. -1 because we count rows from zero
-                if row>(gameBoard.height-1): stopRowScan=True
-
-            numVoids.append(voidCount)
-            voidCount=0
+        # For each column, count the voids from the top of the board down, stopping as soon as you hit a non-void
+        numVoids=gameBoard.voidDepths()
 
     if verbose: print("\tnumVoids array is",numVoids)
 
@@ -591,41 +1224,30 @@ def makeMove(gameBoard,chosenBox):
                         y=0
                         if verbose: print("\t\tMaking box at x,y=",valleyStartX,y,"with height",height)
                         gameBoard.makeBox(valleyStartX,y,valleyWidth,height,0)
-                        updateScreenBuffer(gameBoard)
 
-                        distanceToFall=999
                         if verbose: print("\t\tComputing fall distance over range",valleyStartX,valleyStartX+valleyWidth)
-                        for kk in range(valleyStartX,valleyStartX+valleyWidth):
-                            stopFound=False
-                            jj=0
-                            while stopFound==False:
-                                if height+jj<gameBoard.height:
-                                    if gameBoard.screenBuffer[((height+jj)*2)+1][((kk)*2)+1] !=VOID:
-                                        stopFound=True
-                                    else:
-                                        jj+=1
-                                else:
-                                    stopFound=True
-
-                            if distanceToFall>jj:
-                                distanceToFall=jj
+                        distanceToFall=gameBoard.fallDistance(valleyStartX,height,valleyWidth)
 
                         if distanceToFall>0:
                             if verbose: print("\t\tReadjusting y position (fall",distanceToFall,"units)")
                             box=gameBoard.box[-1]
-                            box.modify(box.x,box.y+distanceToFall,box.width,box.height,box.points)
+                            gameBoard.moveBox(box,box.x,box.y+distanceToFall)
 
-                        updateScreenBuffer(gameBoard)
                         fillingHappened=True
                         for jj in range(0,valleyWidth):
                             numVoids[valleyStartX+jj]-=ii
                             deepestDepth-=ii
 
 
+    if journal is not None: journal.numFilled=len(gameBoard.box)-numBoxesBeforeFilling
+    if profiler is not None:
+        profiler.lap('filling')
+        profiler.count('fillBlocks',len(gameBoard.box)-numBoxesBeforeFilling)
+
     # -------- 7. Determine whether four or more similar boxes are now adjacent   -----------------------------------------------
     #
     #	This is almost a copy paste of step 2, except there we only had to look in the vicinity of the box we just split. Now we
-    #	have to scan all boxes
+    #	have to scan all cluster candidates, whatever their size
 
     if verbose:
         drawScreen(gameBoard)
@@ -637,38 +1259,27 @@ def makeMove(gameBoard,chosenBox):
     else:
         if verbose:	print("\tSomething fell, so looking for new clusters")
 
-        for box in gameBoard.box:
-            if box.points==0:
-
-                setMembers=[] #Set of identical neighbours for this box
-
-                for otherboxindex,otherbox in enumerate(gameBoard.box):
-                    if otherbox.points==0:
-                        if box==otherbox:	#Equality method compares width, height and number of points.
-                            # If otherbox is beside box
-                            if otherbox.x==(box.x+box.width) and otherbox.y==box.y:	setMembers.append(otherboxindex)
-                            # If otherbox is diagonal to box
-                            elif otherbox.x==(box.x+box.width) and otherbox.y==(box.y+box.height):	setMembers.append(otherboxindex)
-                            # If otherbox is below box
-                            elif otherbox.x==box.x and otherbox.y==(box.y+box.height):	setMembers.append(otherboxindex)
-
-                if len(setMembers)==3:
-                    # We found a set of four, and {box} is the one in the upper left
-                    # So we should assign points to the whole set
-                    # For now we just make a note to assign these points, but don't actually do it until the end of the scan. Otherwise we'll mess up the ongoing scan
-                    # e.g. if you find a group of 4 and immediately make them point blocks, you will not notice if they are actually part of 6+ block cluster
-                    box.temppoints=len(gameBoard.splitRecord)+1
-                    gameBoard.box[setMembers[0]].temppoints=len(gameBoard.splitRecord)+1
-                    gameBoard.box[setMembers[1]].temppoints=len(gameBoard.splitRecord)+1
-                    gameBoard.box[setMembers[2]].temppoints=len(gameBoard.splitRecord)+1
-                    if verbose:	print("Found a cluster")
+        clusterMembers=[]
+        if profiler is not None: profiler.count('clusterCandidatesScanned',len(gameBoard.clusterCandidates))
+        for group in gameBoard.findClusters():
+            # We found a set of four, and group[0] is the one in the upper left
+            # So we should assign points to the whole set
+            # For now we just make a note to assign these points, but don't actually do it until the end of the scan. Otherwise we'll mess up the ongoing scan
+            # e.g. if you find a group of 4 and immediately make them point blocks, you will not notice if they are actually part of 6+ block cluster
+            for box in group:
+                box.temppoints=len(gameBoard.splitRecord)+1
+            clusterMembers.extend(group)
+            if verbose:	print("Found a cluster")
 
         # Any newly created clusters should also be immediately decremented and points awarded (they weren't around when the rest of the blocks had this done)
-        for box in gameBoard.box:
+        for box in clusterMembers:
             if box.temppoints != 0:
-                box.points+=box.temppoints-1
+                if journal is not None: journal.touch(box)
+                gameBoard.setPoints(box,box.points+box.temppoints-1)
                 countDownScore+=1
                 box.temppoints=0
+        if profiler is not None: profiler.count('clusterBoxes',len(clusterMembers))
+    if profiler is not None: profiler.lap('recluster')
 
     # -------- 8. Process halving of points from falling   ----------------------------------------------------------------------
     #
@@ -688,12 +1299,15 @@ def makeMove(gameBoard,chosenBox):
                 if box.points>1:
                     if verbose: print("\tBox",boxindex,"had",box.points,"points, reducing it to",box.points//2,"and incrementing score by",int(math.ceil(box.points/2.0)))
                     countDownScore+=int(math.ceil(box.points/2.0))
-                    box.points=box.points//2
+                    if journal is not None: journal.touch(box)
+                    gameBoard.setPoints(box,box.points//2)
+                    if profiler is not None: profiler.count('halvings')
                 else:
                     if verbose: print("\tBox",boxindex,"only had",box.points,"point, leaving it alone")
 
                 box.temppoints=0
                 box.fellFlag=0
+    if profiler is not None: profiler.lap('halving')
 
 
 
@@ -706,4 +1320,91 @@ def makeMove(gameBoard,chosenBox):
         print("\t Score update {0} --> {1}\n\n".format(gameBoard.score,gameBoard.score+1+countDownScore+blockDestructionScore))
 
     gameBoard.score=gameBoard.score+1+countDownScore+blockDestructionScore
+    if journal is not None: gameBoard.undoLog.append(journal)
     return True
+
+
+
+
+# Reverts the most recent move made with makeMove(gameBoard,chosenBox,undo=True). Only the boxes the move touched are
+# restored, so this takes time proportional to the size of the move rather than the size of the board.
+# Returns False if there is no move to undo
+##########################################
+def undoMove(gameBoard):
+##########################################
+    if len(gameBoard.undoLog)==0:
+        return False
+    journal=gameBoard.undoLog.pop()
+    boxes=gameBoard.box
+
+    # Take everything that is going to move, or disappear, out of the occupancy and geometry indexes
+    created=boxes[len(boxes)-journal.numFilled:]+[journal.splitBox]
+    del boxes[len(boxes)-journal.numFilled:]
+    boxes.pop()		#The box created by the split is always the last survivor
+
+    removedIds=set(id(box) for boxindex,box in journal.removed)
+    createdIds=set(id(box) for box in created)
+    restored=[]		#Boxes which existed before the move, and whose fields need restoring
+    reshaped=[]		#The subset of those which are still on the board, but moved or changed shape
+    for box,x,y,width,height,points in journal.touched.values():
+        if id(box) in createdIds:
+            continue
+        restored.append((box,x,y,width,height,points))
+        if id(box) not in removedIds and (box.x,box.y,box.width,box.height)!=(x,y,width,height):
+            reshaped.append(box)
+    for box in created+reshaped:
+        gameBoard.cellBox[box.y:box.y+box.height,box.x:box.x+box.width]=-1
+        gameBoard.splittable[:,box.y:box.y+box.height,box.x:box.x+box.width]=False
+        gameBoard.unindexBox(box)
+
+    # Put the destroyed boxes back where they were, and renumber the boxes after them
+    if len(journal.removed)>0:
+        newIndex=np.arange(len(boxes)+len(created)+1,dtype=np.int32)
+        newIndex[-1]=-1
+        for boxindex,box in journal.removed:
+            boxes.insert(boxindex,box)
+        for boxindex in range(journal.removed[0][0],len(boxes)):
+            box=boxes[boxindex]
+            if id(box) not in removedIds:
+                newIndex[box.index]=boxindex
+            box.index=boxindex
+        gameBoard.cellBox[:]=newIndex[gameBoard.cellBox]
+
+    # Restore the fields of every box the move changed, and put the boxes that moved back in the indexes
+    for box,x,y,width,height,points in restored:
+        box.modify(x,y,width,height,points)
+        gameBoard.paintSplittable(box)
+    for box in reshaped+[box for boxindex,box in journal.removed]:
+        gameBoard.cellBox[box.y:box.y+box.height,box.x:box.x+box.width]=box.index
+        gameBoard.boxAtGeometry[geometryKey(box.x,box.y,box.width,box.height)]=box
+
+    for box in gameBoard.clusterCandidates:
+        box.clusterCandidate=0
+    gameBoard.clusterCandidates=journal.clusterCandidates
+    for box in gameBoard.clusterCandidates:
+        box.clusterCandidate=1
+
+    gameBoard.splitAction=journal.splitAction
+    gameBoard.score=journal.score
+    gameBoard.zobrist=journal.zobrist
+    gameBoard.splitRecord.pop()
+    return True
+
+
+
+# Evaluates every legal move on gameBoard by making it and undoing it again, so gameBoard ends up as it was. Boxes the
+# moves do not touch are shared rather than copied for each candidate.
+# Returns a list of (chosenBox,scoreGain,gameOver) in getMoveOptions() order, where gameOver is True if there are no
+# legal moves left after that move. If visit is given, visit(gameBoard,chosenBox) is called while each move is applied
+##########################################
+def previewMoves(gameBoard,visit=None):
+##########################################
+    previews=[]
+    score=gameBoard.score
+    for chosenBox in gameBoard.getMoveOptions():
+        makeMove(gameBoard,chosenBox,undo=True)
+        previews.append((chosenBox,gameBoard.score-score,not gameBoard.legalCells().any()))
+        if visit is not None:
+            visit(gameBoard,chosenBox)
+        undoMove(gameBoard)
+    return previews
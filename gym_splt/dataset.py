@@ -0,0 +1,255 @@
+"""Record SpltEnv transitions to memory-mapped shards, and load them back.
+
+A dataset is a directory of fixed-size shards plus an episode log:
+
+    dataset/
+        shard-00000/
+            observations.npy   uint8 (shard_size, 5, height, width)
+            actions.npy        int64 (shard_size,)
+            rewards.npy        float32 (shard_size,)
+            dones.npy          bool (shard_size,)
+            episodes.npy       int64 (shard_size,), the episode of each row
+            moves.npy          int64 (shard_size,), moves made before the row
+            meta.json          {"length": rows actually written}
+        shard-00001/
+        ...
+        episodes.jsonl         one line per episode with its splitRecord
+
+Each row is an observation and the action taken from it, with the reward
+and done flag that followed. The columns are .npy files written through
+memory maps, so recording never holds more than the pages being written
+in RAM. With `store_observations=False` the observations are left out,
+and positions can be rebuilt from the episode's splitRecord and the move
+number with `gym_splt.replay`.
+"""
+import json
+import os
+
+import gym
+import numpy as np
+
+COLUMNS = {
+    'actions': np.int64,
+    'rewards': np.float32,
+    'dones': np.bool_,
+    'episodes': np.int64,
+    'moves': np.int64,
+}
+
+
+def shard_dirs(path):
+    return sorted(os.path.join(path, name) for name in os.listdir(path)
+                  if name.startswith('shard-'))
+
+
+class ShardWriter(object):
+    """Appends transitions to the shards of a dataset directory, starting a
+    new shard every `shard_size` rows. Recording into an existing dataset
+    adds new shards and episodes after the existing ones."""
+
+    def __init__(self, path, observation_shape, shard_size=65536,
+                 store_observations=True):
+        self.path = path
+        self.observation_shape = tuple(observation_shape)
+        self.shard_size = shard_size
+        self.store_observations = store_observations
+        os.makedirs(path, exist_ok=True)
+        self.n_shards = len(shard_dirs(path))
+        self.episodes_path = os.path.join(path, 'episodes.jsonl')
+        self.n_episodes = 0
+        if os.path.exists(self.episodes_path):
+            with open(self.episodes_path) as f:
+                self.n_episodes = sum(1 for _ in f)
+        self.columns = None
+        self.length = 0
+
+    def _open_shard(self):
+        self.shard_path = os.path.join(
+            self.path, 'shard-{:05d}'.format(self.n_shards))
+        os.makedirs(self.shard_path)
+        self.n_shards += 1
+        self.columns = {}
+        shapes = {name: (self.shard_size,) for name in COLUMNS}
+        dtypes = dict(COLUMNS)
+        if self.store_observations:
+            shapes['observations'] = (self.shard_size,) + self.observation_shape
+            dtypes['observations'] = np.uint8
+        for name, shape in shapes.items():
+            self.columns[name] = np.lib.format.open_memmap(
+                os.path.join(self.shard_path, name + '.npy'), mode='w+',
+                dtype=dtypes[name], shape=shape)
+        self.length = 0
+
+    def _close_shard(self):
+        for column in self.columns.values():
+            column.flush()
+        with open(os.path.join(self.shard_path, 'meta.json'), 'w') as f:
+            json.dump({'length': self.length}, f)
+        self.columns = None
+
+    def add(self, observation, action, reward, done, episode, move):
+        if self.columns is None:
+            self._open_shard()
+        row = self.length
+        if self.store_observations:
+            self.columns['observations'][row] = observation
+        self.columns['actions'][row] = action
+        self.columns['rewards'][row] = reward
+        self.columns['dones'][row] = done
+        self.columns['episodes'][row] = episode
+        self.columns['moves'][row] = move
+        self.length += 1
+        if self.length == self.shard_size:
+            self._close_shard()
+
+    def new_episode(self):
+        """Return the id of a new episode. Ids are assigned in order."""
+        self.n_episodes += 1
+        return self.n_episodes - 1
+
+    def end_episode(self, episode, split_record, score):
+        with open(self.episodes_path, 'a') as f:
+            f.write(json.dumps({'episode': episode,
+                                'splitRecord': list(split_record),
+                                'score': score}) + '\n')
+
+    def close(self):
+        if self.columns is not None:
+            self._close_shard()
+
+
+class TrajectoryRecorder(gym.Wrapper):
+    """Records every transition of a `SpltEnv` into a dataset directory
+    with a `ShardWriter`. Episodes are logged with their splitRecord when
+    they end, at `reset` or at `close`. Like the env, every episode has to
+    be started with `reset`."""
+
+    def __init__(self, env, path, shard_size=65536, store_observations=True):
+        super(TrajectoryRecorder, self).__init__(env)
+        self.writer = ShardWriter(path, env.observation_space.shape,
+                                  shard_size, store_observations)
+        self.episode = None
+        self.observation = None
+
+    def reset(self, **kwargs):
+        self._end_episode()
+        self.observation = self.env.reset(**kwargs)
+        self.episode = self.writer.new_episode()
+        return self.observation
+
+    def step(self, action):
+        if self.episode is None:
+            raise gym.error.ResetNeeded(
+                'Call reset before step, and again after an episode ends')
+        board = self.env.unwrapped.board
+        move = len(board.splitRecord)
+        observation, reward, done, info = self.env.step(action)
+        self.writer.add(self.observation, action, reward, done,
+                        self.episode, move)
+        self.observation = observation
+        if done:
+            self._end_episode()
+        return observation, reward, done, info
+
+    def close(self):
+        self._end_episode()
+        self.writer.close()
+        return self.env.close()
+
+    def _end_episode(self):
+        if self.episode is not None:
+            board = self.env.unwrapped.board
+            self.writer.end_episode(self.episode, board.splitRecord,
+                                    board.score)
+            self.episode = None
+
+
+class ShardDataset(object):
+    """Memory-mapped, read-only view of a recorded dataset."""
+
+    def __init__(self, path):
+        self.path = path
+        self.shards = []
+        for shard_path in shard_dirs(path):
+            meta_path = os.path.join(shard_path, 'meta.json')
+            if not os.path.exists(meta_path):
+                continue  # Still being written
+            with open(meta_path) as f:
+                length = json.load(f)['length']
+            columns = {}
+            for name in os.listdir(shard_path):
+                if name.endswith('.npy'):
+                    column = np.load(os.path.join(shard_path, name),
+                                     mmap_mode='r')
+                    columns[name[:-len('.npy')]] = column[:length]
+            self.shards.append(columns)
+
+    def __len__(self):
+        return sum(len(shard['actions']) for shard in self.shards)
+
+    def episodes(self):
+        """Return the logged episodes, as a dict from episode id to a dict
+        with 'splitRecord' and 'score'."""
+        episodes = {}
+        with open(os.path.join(self.path, 'episodes.jsonl')) as f:
+            for line in f:
+                episode = json.loads(line)
+                episodes[episode['episode']] = episode
+        return episodes
+
+    def batches(self, batch_size, shuffle=True, rows=False, seed=None,
+                drop_last=False):
+        """Yield mini-batches as dicts of column arrays.
+
+        By default a batch is a block of `batch_size` consecutive rows of one
+        shard, and its arrays are views of the memory maps, so nothing is
+        copied until the batch is used. Blocks are visited in shuffled
+        order. With `rows=True`, batches are instead drawn from rows
+        shuffled across the whole dataset, which means gathering them into
+        new arrays.
+        """
+        rng = np.random.default_rng(seed)
+        if rows:
+            starts = np.cumsum([0] + [len(shard['actions'])
+                                      for shard in self.shards])
+            order = np.arange(starts[-1])
+            if shuffle:
+                rng.shuffle(order)
+            for begin in range(0, len(order), batch_size):
+                picked = order[begin:begin + batch_size]
+                if drop_last and len(picked) < batch_size:
+                    break
+                yield self._gather(picked, starts)
+            return
+
+        blocks = []
+        for shard_index, shard in enumerate(self.shards):
+            for begin in range(0, len(shard['actions']), batch_size):
+                if (drop_last
+                        and begin + batch_size > len(shard['actions'])):
+                    break
+                blocks.append((shard_index, begin))
+        if shuffle:
+            rng.shuffle(blocks)
+        for shard_index, begin in blocks:
+            shard = self.shards[shard_index]
+            yield {name: column[begin:begin + batch_size]
+                   for name, column in shard.items()}
+
+    def _gather(self, picked, starts):
+        shard_of_row = np.searchsorted(starts, picked, side='right') - 1
+        # Shards recorded without observations only have the other columns
+        names = set.intersection(*(set(shard) for shard in self.shards))
+        batch = {name: np.empty((len(picked),) + column.shape[1:],
+                                dtype=column.dtype)
+                 for name, column in self.shards[0].items() if name in names}
+        for shard_index in np.unique(shard_of_row):
+            in_shard = shard_of_row == shard_index
+            local = picked[in_shard] - starts[shard_index]
+            # Read rows in file order, then put them back in batch order
+            order = np.argsort(local)
+            positions = np.flatnonzero(in_shard)[order]
+            for name in names:
+                batch[name][positions] = (
+                    self.shards[shard_index][name][local[order]])
+        return batch
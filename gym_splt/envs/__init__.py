@@ -1 +1,3 @@
-from gym_splt.envs.splt_env import SpltEnv
\ No newline at end of file
+from gym_splt.envs.splt_env import SpltEnv
+from gym_splt.envs.splt_vec_env import SpltVecEnv
+from gym_splt.envs.splt_subproc_vec_env import SpltSubprocVecEnv
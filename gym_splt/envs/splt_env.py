@@ -4,38 +4,70 @@ from gym.utils import seeding
 from gym_splt import core
 import numpy as np
 from math import log2
+import struct
 
-translate_buffer_to_state = {
-    core.NOPOINT: 0, core.VOID: -1,
-    core.HORIZONTAL: 1, core.VERTICAL: 1, 
-    'p': 1
-}
+# clone_state() prefixes the board snapshot with the number of move attempts
+env_state_header = struct.Struct('<q')
 
 
 class SpltEnv(gym.Env):
-    metadata = {'render.modes': ['human']}
+    metadata = {'render.modes': ['human', 'ansi', 'rgb_array']}
 
-    def __init__(self, width=4, height=8, max_time=500):
+    def __init__(self, width=4, height=8, max_time=500,
+                 copy_observations=True, transition_cache=None,
+                 action_mode='cell', max_slots=None, profiler=None,
+                 render_cell_size=16):
+        if action_mode not in ('cell', 'box'):
+            raise ValueError('action_mode must be "cell" or "box", not {!r}'
+                             .format(action_mode))
         self.width = width
         self.height = height
-        self.board = core.Board(width=self.width, height=self.height)
+        # An optional core.MoveProfiler, which may be shared between envs
+        self.profiler = profiler
+        self.board = self._new_board()
         self.n_state_layers = 5
-        self.state = self._get_state() 
-        self.n_actions = width * height
+        self.encoder = StateEncoder(width, height, self.n_state_layers)
+        self.copy_observations = copy_observations
+        # An optional core.TransitionCache, which may be shared between envs
+        self.transition_cache = transition_cache
+        self.state = self._get_state()
+        # In 'cell' mode an action is a cell, and splits the box covering it.
+        # In 'box' mode an action is a slot of self.box_slots, and splits the
+        # box in that slot
+        self.action_mode = action_mode
+        self.box_slots = None
+        if action_mode == 'box':
+            self.box_slots = BoxSlots(width, height, max_slots)
+            self.box_slots.update(self.board)
+            self.n_actions = self.box_slots.max_slots
+        else:
+            self.n_actions = width * height
+        self._action_mask = np.zeros(self.n_actions, dtype=bool)
+        self._action_mask_view = self._action_mask.view()
+        self._action_mask_view.flags.writeable = False
         self.action_space = spaces.Discrete(self.n_actions)
         self.observation_space = spaces.Box(low=0, high=15, 
             shape=self.state.shape, dtype=np.uint8)
         self.time = 0
         self.max_time = max_time
         self.penalty_impossible = 1
+        # Frames are drawn at most once per step, and only when asked for
+        self.render_cell_size = render_cell_size
+        self.renderer = None
+        self._frames = {}
 
     def step(self, action):
         self.time += 1
-        # Translate action to (x,y) coordinates
-        x = action % self.width
-        y = action // self.width
         pre_score = self.board.score
-        possible = split_x_y(self.board, x, y)
+        if self.action_mode == 'box':
+            possible = self.box_slots.split(self.board, action,
+                                            self.transition_cache)
+            self.box_slots.update(self.board)
+        else:
+            # Translate action to (x,y) coordinates
+            x = action % self.width
+            y = action // self.width
+            possible = split_x_y(self.board, x, y, self.transition_cache)
 
         # Check if move can be made
         if not possible:
@@ -43,81 +75,136 @@ class SpltEnv(gym.Env):
             self.board.score -= self.penalty_impossible
         reward = self.board.score - pre_score
         self.state = self._get_state()
+        self._frames.clear()
 
         # Check if we are done
         done = self._is_done()
-        return (self.state, reward, done, {})
+        return (self.state, reward, done, {'action_mask': self.action_mask()})
 
     def reset(self):
-        self.board = core.Board(width=self.width, height=self.height)
+        self.board = self._new_board()
+        if self.box_slots is not None:
+            self.box_slots.update(self.board)
         self.state = self._get_state()
         self.time = 0
+        self._frames.clear()
         return self.state
 
     def render(self, mode='human', close=False):
-        core.drawScreen(self.board)
+        """Print the board ('human'), or return it as the text that would
+        be printed ('ansi') or as an RGB image ('rgb_array', see
+        `BoardRenderer`). Frames are cached until the next step. Like
+        observations, images are copies unless `copy_observations` is
+        False, in which case they are a read-only view that the next step's
+        frame overwrites."""
+        if mode == 'human':
+            print(self._frame('ansi'), end='')
+        elif mode == 'ansi':
+            return self._frame('ansi')
+        elif mode == 'rgb_array':
+            image = self._frame('rgb_array')
+            return image.copy() if self.copy_observations else image
+        else:
+            raise error.UnsupportedMode('Unsupported render mode {!r}'
+                                        .format(mode))
 
-    def _get_board_state(self, buffer=None):
-        if buffer is None:
-            buffer = np.array(self.board.screenBuffer)
+    def _frame(self, mode):
+        frame = self._frames.get(mode)
+        if frame is None:
+            if mode == 'ansi':
+                frame = core.screenText(self.board)
+            else:
+                if self.renderer is None:
+                    self.renderer = BoardRenderer(self.width, self.height,
+                                                  self.render_cell_size)
+                frame = self.renderer.render(self.board, copy=False)
+            self._frames[mode] = frame
+        return frame
 
-        state = np.zeros(shape=(self.n_state_layers, self.height, self.width))
+    def action_mask(self):
+        """Return a boolean array over actions, True where the action splits
+        a box. Like observations, it is a copy unless `copy_observations` is
+        False, in which case it is a read-only view that the next call
+        overwrites."""
+        if self.action_mode == 'box':
+            self._action_mask[:] = self.box_slots.mask
+        else:
+            self._action_mask[:] = self.board.legalCells().reshape(-1)
+        if self.copy_observations:
+            return self._action_mask.copy()
+        return self._action_mask_view
 
-        top_walls = buffer[:-2:2, 1::2]
-        side_walls = buffer[1::2, 2::2]
-        insides = buffer[1::2, 1::2]
-        # Layer 0: Void
-        is_void = np.zeros(shape=(self.height, self.width))
-        void_mask = insides == core.VOID
-        is_void[void_mask] = 1
-        state[0] = is_void
-        # Layer 1: log2(points)
-        log_points = np.ones(shape=(self.height, self.width))
-        nopoint_mask = insides == core.NOPOINT
-        log_points[~void_mask & ~nopoint_mask] = insides[~void_mask & ~nopoint_mask]
-        log_points = np.log2(log_points)
-        state[1] = log_points
-        # Layer 2: Is wall on top?
-        top = np.zeros(shape=(self.height, self.width))
-        top_mask = top_walls != ' ' # If not a space, it is a wall
-        top[top_mask] = 1
-        state[2] = top
-        # Layer 3: Is wall on left?
-        side = np.zeros(shape=(self.height, self.width))
-        side_mask = side_walls != ' ' # If not a space, it is a wall
-        side[side_mask] = 1
-        state[3] = side
-        # Layer 4: metadata - game length, vert/horizontal parity
-        metadata = self._get_state_metadata()
-        state[4, 0, :2] = metadata
-
-        return state
-
-    def _get_state_metadata(self):
-        # Indicate parity
-        if self.board.splitAction == core.VERTICAL:
-            parity = 0
-        else: 
-            parity = 1
-        # How many legal moves have been done?
-        game_length = len(self.board.splitRecord) + 1
-        log2_game_length = np.log2(game_length)
-        # Add to array
-        state = np.zeros(2)
-        state[0] = parity
-        state[1] = log2_game_length
-        return state
+    def preview_actions(self, observations=False):
+        """Return what `step` would give for every action, without changing
+        the env: (rewards, dones, observations), stacked along the first
+        axis in action order. observations is None unless asked for.
 
-    def _get_state(self):
-        core.updateScreenBuffer(self.board)
-        buffer = np.array(self.board.screenBuffer)
-        board_state = self._get_board_state(buffer)
+        Each legal move is made and undone once with `core.previewMoves`,
+        and all actions on the same box share the result.
+        """
+        board = self.board
+        n_boxes = len(board.box)
+        out_of_time = self.time + 1 > self.max_time
+        # One entry per box, and a last one for impossible moves, which
+        # leave the board unchanged, so are done like `step` on it would be
+        box_rewards = np.full(n_boxes + 1, -self.penalty_impossible,
+                              dtype=float)
+        box_dones = np.full(n_boxes + 1,
+                            out_of_time or not board.legalCells().any())
+        # Row of box_states with the observation after splitting each box.
+        # Boxes that cannot be split use the last row, the current state
+        box_rows = np.full(n_boxes + 1, n_boxes)
+        box_states = None
+        if observations:
+            box_states = np.empty((n_boxes + 1,) + self.encoder.state.shape,
+                                  dtype=np.uint8)
+            self.encoder.encode(board, out=box_states[n_boxes])
+
+        def visit(board, chosen_box):
+            self.encoder.encode(board, out=box_states[chosen_box])
+
+        previews = core.previewMoves(board, visit if observations else None)
+        for chosen_box, reward, game_over in previews:
+            box_rewards[chosen_box] = reward
+            box_dones[chosen_box] = game_over or out_of_time
+            box_rows[chosen_box] = chosen_box
+
+        if self.action_mode == 'box':
+            action_boxes = self.box_slots.box_index
+        else:
+            action_boxes = board.cellBox.reshape(-1)
+        # Empty slots and void cells are -1, which picks the last entry
+        states = None
+        if box_states is not None:
+            states = box_states[box_rows[action_boxes]]
+        return box_rewards[action_boxes], box_dones[action_boxes], states
+
+    def clone_state(self):
+        """Return the state of the env as compact bytes, see
+        `core.Board.snapshot`."""
+        return env_state_header.pack(self.time) + self.board.snapshot()
+
+    def restore_state(self, state):
+        """Return the env to a state from `clone_state`, reusing the
+        current board."""
+        self.time, = env_state_header.unpack_from(state)
+        self.board.restore(state[env_state_header.size:])
+        if self.box_slots is not None:
+            self.box_slots.update(self.board)
+        self.state = self._get_state()
+        self._frames.clear()
+        return self.state
+
+    def _new_board(self):
+        board = core.Board(width=self.width, height=self.height)
+        board.profiler = self.profiler
+        return board
 
-        return board_state
+    def _get_state(self):
+        return self.encoder.encode(self.board, copy=self.copy_observations)
 
     def _is_done(self):
-        move_options = self.board.getMoveOptions()
-        if len(move_options) == 0:
+        if not self.board.legalCells().any():
             # If there are no possible moves, the game is over
             done = True
         elif self.time > self.max_time:
@@ -128,9 +215,297 @@ class SpltEnv(gym.Env):
         return done
 
 
-def split_x_y(board, x, y):
-    for boxindex, box in enumerate(board.box):
-        if box.x <= x < (box.x + box.width):
-            if box.y <= y < (box.y + box.height):
-                return core.makeMove(board, boxindex)
-    return False
+class StateEncoder(object):
+    """Encodes boards into a reused, preallocated uint8 observation.
+
+    The layers are computed from the box list and the board's occupancy
+    index, and the log2 layers are rounded down to integers:
+
+        0: void cells
+        1: log2(points)
+        2: wall on top of the cell
+        3: wall on the right of the cell
+        4: metadata, [0, 0] is the split parity and [0, 1] log2(game length)
+
+    `encode` returns a fresh copy by default. With `copy=False` it returns a
+    read-only view of the internal buffer, which is overwritten by the next
+    call.
+    """
+
+    def __init__(self, width, height, n_state_layers=5):
+        self.width = width
+        self.height = height
+        self.n_state_layers = n_state_layers
+        self.state = np.zeros((n_state_layers, height, width), dtype=np.uint8)
+        self._view = self.state.view()
+        self._view.flags.writeable = False
+        self._log2_table = _log2_table(64)
+
+    def encode(self, board, out=None, copy=True):
+        """Write the observation for `board` into `out` (default: the
+        internal buffer) and return it."""
+        target = self.state if out is None else out
+        ids = board.cellBox
+        points = [box.points for box in board.box]
+        points.append(0)  # Void cells have id -1, and so pick up the last entry
+        points = np.maximum(points, 0)
+        if points.max() >= len(self._log2_table):
+            self._log2_table = _log2_table(2 * int(points.max()))
+        log2_points = self._log2_table[points]
+
+        # Layer 0: Void
+        np.less(ids, 0, out=target[0])
+        # Layer 1: log2(points)
+        np.take(log2_points, ids, out=target[1])
+        # Layer 2: Is wall on top? There is a wall between two different
+        # boxes, or a box and a void
+        np.greater_equal(ids[0], 0, out=target[2, 0])
+        np.not_equal(ids[1:], ids[:-1], out=target[2, 1:])
+        # Layer 3: Is wall on the right?
+        np.not_equal(ids[:, :-1], ids[:, 1:], out=target[3, :, :-1])
+        np.greater_equal(ids[:, -1], 0, out=target[3, :, -1])
+        # Layer 4: metadata - game length, vert/horizontal parity
+        target[4:] = 0
+        target[4, 0, 0] = board.splitAction != core.VERTICAL
+        target[4, 0, 1] = (len(board.splitRecord) + 1).bit_length() - 1
+
+        if out is not None:
+            return out
+        if copy:
+            return self.state.copy()
+        return self._view
+
+    def encode_many(self, boards, out=None):
+        """Write the observations for a sequence of boards into the rows of
+        `out` (default: a new array) and return it. The occupancy indexes of
+        all boards are stacked, so every layer is computed in one pass."""
+        n = len(boards)
+        if out is None:
+            out = np.empty((n,) + self.state.shape, dtype=np.uint8)
+        ids = np.stack([board.cellBox for board in boards])
+        counts = [len(board.box) for board in boards]
+        points = [box.points for board in boards for box in board.box]
+        points.append(0)  # Void cells are pointed at the last entry below
+        points = np.maximum(points, 0)
+        if points.max() >= len(self._log2_table):
+            self._log2_table = _log2_table(2 * int(points.max()))
+        log2_points = self._log2_table[points]
+        offsets = np.zeros(n, dtype=ids.dtype)
+        np.cumsum(counts[:-1], out=offsets[1:])
+        flat_ids = ids + offsets[:, None, None]
+        flat_ids[ids < 0] = len(points) - 1
+
+        # Layer 0: Void
+        np.less(ids, 0, out=out[:, 0])
+        # Layer 1: log2(points)
+        np.take(log2_points, flat_ids, out=out[:, 1])
+        # Layer 2: Is wall on top?
+        np.greater_equal(ids[:, 0], 0, out=out[:, 2, 0])
+        np.not_equal(ids[:, 1:], ids[:, :-1], out=out[:, 2, 1:])
+        # Layer 3: Is wall on the right?
+        np.not_equal(ids[:, :, :-1], ids[:, :, 1:], out=out[:, 3, :, :-1])
+        np.greater_equal(ids[:, :, -1], 0, out=out[:, 3, :, -1])
+        # Layer 4: metadata - game length, vert/horizontal parity
+        out[:, 4:] = 0
+        out[:, 4, 0, 0] = [board.splitAction != core.VERTICAL
+                           for board in boards]
+        # frexp gives the exponent e of 2**(e-1) <= n < 2**e, i.e. bit_length
+        _, lengths = np.frexp([len(board.splitRecord) + 1 for board in boards])
+        out[:, 4, 0, 1] = lengths - 1
+        return out
+
+
+# 3x5 bitmaps of the digits, for the point counters of BoardRenderer
+_DIGITS = np.array([
+    [[1, 1, 1], [1, 0, 1], [1, 0, 1], [1, 0, 1], [1, 1, 1]],
+    [[0, 1, 0], [1, 1, 0], [0, 1, 0], [0, 1, 0], [1, 1, 1]],
+    [[1, 1, 1], [0, 0, 1], [1, 1, 1], [1, 0, 0], [1, 1, 1]],
+    [[1, 1, 1], [0, 0, 1], [1, 1, 1], [0, 0, 1], [1, 1, 1]],
+    [[1, 0, 1], [1, 0, 1], [1, 1, 1], [0, 0, 1], [0, 0, 1]],
+    [[1, 1, 1], [1, 0, 0], [1, 1, 1], [0, 0, 1], [1, 1, 1]],
+    [[1, 1, 1], [1, 0, 0], [1, 1, 1], [1, 0, 1], [1, 1, 1]],
+    [[1, 1, 1], [0, 0, 1], [0, 0, 1], [0, 0, 1], [0, 0, 1]],
+    [[1, 1, 1], [1, 0, 1], [1, 1, 1], [1, 0, 1], [1, 1, 1]],
+    [[1, 1, 1], [1, 0, 1], [1, 1, 1], [0, 0, 1], [1, 1, 1]],
+], dtype=bool)
+
+
+class BoardRenderer(object):
+    """Rasterizes boards into a reused, preallocated RGB image.
+
+    Every cell is `cell_size` pixels, and walls are one pixel wide lines on
+    the cell borders, so an image is (height * cell_size + 1, width *
+    cell_size + 1, 3) uint8. Cell colours and walls are filled for the
+    whole board at once from the board's occupancy index, like
+    `StateEncoder` does; only the point counters, one per point box, are
+    drawn box by box.
+    """
+
+    void_colour = (48, 48, 48)
+    box_colour = (224, 224, 224)
+    point_colour = (255, 176, 64)
+    wall_colour = (0, 0, 0)
+    digit_colour = (0, 0, 0)
+
+    def __init__(self, width, height, cell_size=16):
+        self.width = width
+        self.height = height
+        self.cell_size = cell_size
+        self.image = np.zeros((height * cell_size + 1, width * cell_size + 1,
+                               3), dtype=np.uint8)
+        self._palette = np.array([self.void_colour, self.box_colour,
+                                  self.point_colour], dtype=np.uint8)
+        self._view = self.image.view()
+        self._view.flags.writeable = False
+        self._ids = np.full((height + 2, width + 2), -1, dtype=np.int32)
+        self._counters = {}  # (points, width, height) -> pixels to draw
+
+    def render(self, board, copy=True):
+        """Draw `board` into the internal image. Returns a copy, or with
+        `copy=False` a read-only view which the next call overwrites."""
+        size = self.cell_size
+        height, width = self.height, self.width
+        image = self.image
+        ids = self._ids
+        ids[1:-1, 1:-1] = board.cellBox
+        points = [box.points for box in board.box]
+
+        # Cell colours: 0 void, 1 box without points, 2 box with points
+        kinds = np.array([1 + (p > 0) for p in points] + [0], dtype=np.intp)
+        # Colour one pixel row per board row, and copy it down the cells
+        rows = self._palette[kinds[board.cellBox]].repeat(size, axis=1)
+        image[:-1, :-1].reshape(height, size, width * size, 3)[:] = (
+            rows[:, None])
+        image[-1] = image[:, -1] = self.void_colour
+
+        # Walls separate two different boxes, or a box and a void, and are
+        # drawn with their end points, where they meet other walls
+        horizontal = ids[:-1, 1:-1] != ids[1:, 1:-1]
+        vertical = ids[1:-1, :-1] != ids[1:-1, 1:]
+        image[::size, :-1].reshape(height + 1, width, size, 3)[
+            horizontal] = self.wall_colour
+        image[:-1, ::size].reshape(height, size, width + 1, 3).transpose(
+            0, 2, 1, 3)[vertical] = self.wall_colour
+        corners = np.zeros((height + 1, width + 1), dtype=bool)
+        corners[:, :-1] |= horizontal
+        corners[:, 1:] |= horizontal
+        corners[:-1] |= vertical
+        corners[1:] |= vertical
+        image[::size, ::size][corners] = self.wall_colour
+
+        for box, p in zip(board.box, points):
+            if p > 0:
+                self._draw_counter(box, p)
+        if copy:
+            return image.copy()
+        return self._view
+
+    def _draw_counter(self, box, points):
+        """Draw the points of a box in its middle, as large as fits."""
+        key = (points, box.width, box.height)
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = self._counters[key] = self._layout_counter(*key)
+        if counter:
+            top, left, mask = counter
+            top += box.y * self.cell_size
+            left += box.x * self.cell_size
+            self.image[top:top + mask.shape[0],
+                       left:left + mask.shape[1]][mask] = self.digit_colour
+
+    def _layout_counter(self, points, width, height):
+        """Return (top, left, mask) of the pixels of a counter, relative to
+        the corner of its box, or False if it does not fit."""
+        digits = [int(d) for d in str(points)]
+        size = self.cell_size
+        n_columns = 4 * len(digits) - 1
+        # Leave a margin of two pixels inside the walls
+        scale = min((width * size - 5) // n_columns,
+                    (height * size - 5) // 5)
+        if scale < 1:
+            return False
+        text = np.zeros((5, n_columns), dtype=bool)
+        for i, digit in enumerate(digits):
+            text[:, 4 * i:4 * i + 3] = _DIGITS[digit]
+        mask = text.repeat(scale, axis=0).repeat(scale, axis=1)
+        top = 1 + (height * size - 1 - mask.shape[0]) // 2
+        left = 1 + (width * size - 1 - mask.shape[1]) // 2
+        return top, left, mask
+
+
+class BoxSlots(object):
+    """Maps a fixed number of action slots to the splittable boxes of a
+    board, so that every legal action splits a different box.
+
+    After `update(board)`, slot i for i < n_slots holds the i-th splittable
+    box in `board.box` order: `box_index[i]` is its index in `board.box` and
+    `cell[i]` the cell action (y * width + x) of its upper left corner. The
+    remaining slots hold -1 and are masked out. A board never has more than
+    width * height // 2 splittable boxes, which is the default `max_slots`;
+    with fewer slots, the boxes that do not fit cannot be chosen.
+
+    The other way round, `cell_slot` holds the slot of the box covering
+    each cell action and `box_slot[i]` the slot of `board.box[i]`, or -1
+    where that box is in no slot.
+
+    The arrays may be passed in, e.g. as rows of arrays shared by several
+    boards.
+    """
+
+    def __init__(self, width, height, max_slots=None, box_index=None,
+                 cell=None, mask=None):
+        self.width = width
+        self.height = height
+        self.max_slots = max_slots or max(1, width * height // 2)
+        shape = (self.max_slots,)
+        self.box_index = (np.full(shape, -1, dtype=np.int32)
+                          if box_index is None else box_index)
+        self.cell = np.full(shape, -1, dtype=np.int32) if cell is None else cell
+        self.mask = np.zeros(shape, dtype=bool) if mask is None else mask
+        self.cell_slot = np.full(width * height, -1, dtype=np.int32)
+        # A board has at most one box per cell. The extra last entry stays
+        # -1, and is what void cells (box index -1) pick in cell_slot
+        self._box_slot = np.full(width * height + 1, -1, dtype=np.int32)
+        self.box_slot = self._box_slot[:-1]
+        self.n_slots = 0
+
+    def update(self, board):
+        """Refill the slots from the legal move index of `board`."""
+        cells = np.flatnonzero(board.legalCells())
+        cell_box = board.cellBox.reshape(-1)
+        # The first cell of a box in row-major order is its upper left corner
+        box_index, first = np.unique(cell_box[cells], return_index=True)
+        n = min(len(box_index), self.max_slots)
+        self.box_index[:n] = box_index[:n]
+        self.box_index[n:] = -1
+        self.cell[:n] = cells[first[:n]]
+        self.cell[n:] = -1
+        self.mask[:n] = True
+        self.mask[n:] = False
+        self._box_slot[:] = -1
+        self._box_slot[box_index[:n]] = np.arange(n)
+        np.take(self._box_slot, cell_box, out=self.cell_slot)
+        self.n_slots = n
+
+    def split(self, board, slot, cache=None):
+        """Split the box in `slot`. Returns False if the slot is empty."""
+        if not 0 <= slot < self.n_slots:
+            return False
+        return core.makeMove(board, int(self.box_index[slot]), cache=cache)
+
+
+def _log2_table(size):
+    table = np.zeros(size, dtype=np.uint8)
+    for points in range(1, size):
+        table[points] = points.bit_length() - 1
+    return table
+
+
+def split_x_y(board, x, y, cache=None):
+    # Cells off the board are impossible moves, and must not wrap around
+    if not (0 <= x < board.width and 0 <= y < board.height):
+        return False
+    boxindex = board.cellBox[y, x]
+    if boxindex < 0:
+        return False
+    return core.makeMove(board, int(boxindex), cache=cache)
@@ -0,0 +1,239 @@
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import traceback
+import weakref
+
+import gym
+from gym import spaces
+import numpy as np
+
+from gym_splt import core
+from gym_splt.envs.splt_vec_env import (SpltVecEnv, action_count,
+                                        buffer_layout)
+
+
+class SpltSubprocVecEnv(gym.Env):
+    """Steps `num_envs` SPL-T boards spread over `num_workers` processes.
+
+    Results are exchanged through one `multiprocessing.shared_memory` block
+    rather than pickled: the parent writes the actions there, each worker
+    steps its share of the boards with a `SpltVecEnv` whose result arrays
+    are views of the block, and the parent reads observations, rewards,
+    dones and action masks straight from it. The only messages on the pipes
+    are one short command to each worker and one reply per step.
+
+    The arrays returned by `step` and `reset` are views of the shared
+    block, which are overwritten by the next step. Boards that finish are
+    reset automatically as in `SpltVecEnv`, and their final observation is
+    kept in `info['terminal_observation']`. Other keyword arguments are
+    passed on to the `SpltVecEnv` of each worker, so a transition cache is
+    per worker. Call `close` to stop the workers; otherwise they are
+    stopped and the block is freed when the env is garbage collected.
+
+    With a `core.MoveProfiler` as `profiler`, every worker profiles its
+    moves with a profiler of its own. `merge_profiles` and `close` add
+    what the workers have recorded since the last merge to `profiler`.
+    """
+    metadata = {'render.modes': []}
+
+    def __init__(self, num_envs=16, width=4, height=8, num_workers=None,
+                 context=None, profiler=None, **env_kwargs):
+        self.num_envs = num_envs
+        self.width = width
+        self.height = height
+        self.n_actions = action_count(width, height,
+                                      env_kwargs.get('action_mode', 'cell'),
+                                      env_kwargs.get('max_slots'))
+        num_workers = min(num_workers or os.cpu_count(), num_envs)
+        self.profiler = profiler
+
+        # The results of SpltVecEnv, plus the actions and final observations
+        self.layout = buffer_layout(num_envs, self.n_actions, width, height)
+        self.layout['actions'] = ((num_envs,), np.int64)
+        self.layout['terminal_states'] = self.layout['states']
+        self.shm = _SharedBlock(create=True, size=_layout_size(self.layout))
+        self.pipes = []
+        self.processes = []
+        # Stops the workers and releases the block, from close() or once
+        # the env is garbage collected or the interpreter exits
+        self._finalizer = weakref.finalize(self, _shutdown, self.pipes,
+                                           self.processes, self.shm)
+        self.buffers = _attach(self.shm.buf, self.layout)
+        for name in ('states', 'rewards', 'dones', 'action_masks'):
+            setattr(self, name, self.buffers[name])
+
+        if isinstance(context, str) or context is None:
+            context = multiprocessing.get_context(context)
+        self.ranges = [(num_envs * k // num_workers,
+                        num_envs * (k + 1) // num_workers)
+                       for k in range(num_workers)]
+        for start, stop in self.ranges:
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=_worker,
+                args=(child_conn, self.shm.name, self.layout, start, stop,
+                      width, height, profiler is not None, env_kwargs),
+                daemon=True)
+            process.start()
+            child_conn.close()
+            self.pipes.append(parent_conn)
+            self.processes.append(process)
+        self.closed = False
+        try:
+            self._wait()  # Workers reply once their boards are set up
+        except Exception:
+            self.close()
+            raise
+
+        self.action_space = spaces.MultiDiscrete([self.n_actions] * num_envs)
+        self.observation_space = spaces.Box(low=0, high=15,
+            shape=self.states.shape, dtype=np.uint8)
+
+    def step_async(self, actions):
+        self.buffers['actions'][:] = np.asarray(actions).reshape(
+            self.num_envs)
+        for pipe in self.pipes:
+            pipe.send('step')
+
+    def step_wait(self):
+        self._wait()
+        infos = [{} for _ in range(self.num_envs)]
+        for i in np.flatnonzero(self.dones):
+            infos[i]['terminal_observation'] = (
+                self.buffers['terminal_states'][i].copy())
+        return self.states, self.rewards, self.dones, infos
+
+    def step(self, actions):
+        self.step_async(actions)
+        return self.step_wait()
+
+    def reset(self):
+        for pipe in self.pipes:
+            pipe.send('reset')
+        self._wait()
+        return self.states
+
+    def action_mask(self):
+        """Return the (num_envs, n_actions) boolean array of legal actions,
+        which is updated in place by `step` and `reset`."""
+        return self.action_masks
+
+    def merge_profiles(self):
+        """Add the moves profiled by the workers since the last merge to
+        `profiler`, and return it."""
+        if self.profiler is None:
+            return None
+        for pipe in self.pipes:
+            pipe.send('profiler')
+        profilers = self._wait()
+        for profiler in profilers:
+            self.profiler.merge(profiler)
+        return self.profiler
+
+    def close(self):
+        if self.closed:
+            return
+        if self.profiler is not None:
+            try:
+                self.merge_profiles()
+            except (BrokenPipeError, EOFError, RuntimeError):
+                pass  # A worker has stopped, and its moves are lost
+        self.closed = True
+        # Drop the views before releasing the block they point into
+        self.buffers = self.states = self.rewards = None
+        self.dones = self.action_masks = None
+        self._finalizer()
+
+    def _wait(self):
+        # Workers reply with None or a result, or with a traceback if they
+        # failed
+        replies = [pipe.recv() for pipe in self.pipes]
+        errors = [reply for reply in replies if isinstance(reply, str)]
+        if errors:
+            raise RuntimeError('Worker failed:\n' + errors[0])
+        return replies
+
+
+def _shutdown(pipes, processes, shm):
+    for pipe in pipes:
+        try:
+            pipe.send('close')
+        except (BrokenPipeError, EOFError):
+            pass  # The worker has already stopped
+    for process in processes:
+        process.join()
+    shm.unlink()
+    shm.close()
+
+
+class _SharedBlock(shared_memory.SharedMemory):
+    """A shared memory block which stays mapped while arrays returned by
+    `step` still point into it, and is unmapped when the last one goes."""
+
+    def close(self):
+        try:
+            super().close()
+        except BufferError:
+            pass
+
+
+def _layout_size(layout):
+    size = 0
+    for shape, dtype in layout.values():
+        # Keep every array 8-byte aligned
+        size += -(-int(np.prod(shape)) * np.dtype(dtype).itemsize // 8) * 8
+    return size
+
+
+def _attach(buf, layout):
+    # np.frombuffer holds on to the buffer, so the block cannot be unmapped
+    # under arrays that still point into it
+    arrays = {}
+    offset = 0
+    for name, (shape, dtype) in layout.items():
+        arrays[name] = np.frombuffer(buf, dtype=dtype, offset=offset,
+                                     count=int(np.prod(shape))).reshape(shape)
+        offset += -(-arrays[name].nbytes // 8) * 8
+    return arrays
+
+
+def _worker(pipe, shm_name, layout, start, stop, width, height, profile,
+            env_kwargs):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        if profile:
+            env_kwargs = dict(env_kwargs, profiler=core.MoveProfiler())
+        _serve(pipe, _attach(shm.buf, layout), start, stop, width, height,
+               env_kwargs)
+    except Exception:
+        pipe.send(traceback.format_exc())
+    finally:
+        shm.close()
+
+
+def _serve(pipe, arrays, start, stop, width, height, env_kwargs):
+    buffers = {name: arrays[name][start:stop]
+               for name in ('states', 'rewards', 'dones', 'action_masks')}
+    env = SpltVecEnv(num_envs=stop - start, width=width, height=height,
+                     buffers=buffers, **env_kwargs)
+    actions = arrays['actions'][start:stop]
+    terminal_states = arrays['terminal_states'][start:stop]
+    pipe.send(None)
+    while True:
+        command = pipe.recv()
+        if command == 'step':
+            _, _, _, infos = env.step(actions)
+            for i, info in enumerate(infos):
+                if 'terminal_observation' in info:
+                    terminal_states[i] = info['terminal_observation']
+        elif command == 'reset':
+            env.reset()
+        elif command == 'profiler':
+            # Sent as a copy, so what it held is not merged twice
+            pipe.send(env.profiler)
+            env.profiler.reset()
+            continue
+        elif command == 'close':
+            return
+        pipe.send(None)
@@ -0,0 +1,235 @@
+import concurrent.futures
+import functools
+import gym
+from gym import spaces
+from gym_splt import core
+from gym_splt.envs.splt_env import BoxSlots, StateEncoder, split_x_y
+import numpy as np
+
+
+class SpltVecEnv(gym.Env):
+    """Steps `num_envs` SPL-T boards in lockstep.
+
+    Observations, rewards, dones and move counters live in preallocated
+    arrays shared by all boards, so one call to `step` takes an array of
+    actions and returns stacked results. Boards that finish are reset
+    automatically; their final observation is kept in
+    `info['terminal_observation']`. `action_masks` holds the legal actions
+    of every board, one row per board.
+
+    This env does not reach the order of magnitude over a list of
+    `SpltEnv` that it was first asked for, and is scoped down to batching
+    everything around the move. Each board is still a `core.Board` and is
+    moved with `core.makeMove` in a Python loop, since falls and fills
+    cascade differently on every board and the original game's quirks have
+    to be kept exactly (see `benchmarks/golden.py`). The observations,
+    masks, rewards and dones are then computed for all boards at once. On
+    4x8 boards with 64 envs this steps about 1.5x as many boards per second
+    as a single `SpltEnv` (about 11k vs 7.5k on one core), and `makeMove`
+    is close to 90% of the remaining time, so any further gain has to come
+    from the engine itself or from more cores (`SpltSubprocVecEnv`).
+
+    With `action_mode='box'`, actions are box slots as in `SpltEnv`, and
+    `slot_boxes` holds the box index in each slot of every board.
+
+    With `num_threads`, the boards are split into that many groups which
+    are stepped concurrently by a thread pool. Every board is only ever
+    touched by one thread, and a shared transition cache or profiler is
+    thread-safe. Call `close` to shut the pool down.
+
+    `buffers` may hold some of the arrays laid out by `buffer_layout`, e.g.
+    views of shared memory, to write results into instead of allocating
+    them.
+    """
+    metadata = {'render.modes': []}
+
+    def __init__(self, num_envs=16, width=4, height=8, max_time=500,
+                 transition_cache=None, action_mode='cell', max_slots=None,
+                 profiler=None, num_threads=None, buffers=None):
+        if action_mode not in ('cell', 'box'):
+            raise ValueError('action_mode must be "cell" or "box", not {!r}'
+                             .format(action_mode))
+        self.num_envs = num_envs
+        self.width = width
+        self.height = height
+        self.n_state_layers = 5
+        self.action_mode = action_mode
+        self.n_actions = action_count(width, height, action_mode, max_slots)
+        self.max_time = max_time
+        self.penalty_impossible = 1
+        self.transition_cache = transition_cache
+        self.profiler = profiler
+
+        self.boards = [self._new_board() for _ in range(num_envs)]
+        self.encoder = StateEncoder(width, height, self.n_state_layers)
+        buffers = buffers or {}
+        layout = buffer_layout(num_envs, self.n_actions, width, height,
+                               self.n_state_layers)
+        for name, (shape, dtype) in layout.items():
+            array = buffers.get(name)
+            if array is None:
+                array = np.zeros(shape, dtype=dtype)
+            elif array.shape != shape or array.dtype != dtype:
+                raise ValueError('Buffer {} should be {} {}, not {} {}'.format(
+                    name, dtype.__name__, shape, array.dtype, array.shape))
+            setattr(self, name, array)
+        self.times = np.zeros(num_envs, dtype=np.int64)
+        self.slot_boxes = self.slot_cells = self.box_slots = None
+        if action_mode == 'box':
+            self.slot_boxes = np.full((num_envs, self.n_actions), -1,
+                                      dtype=np.int32)
+            self.slot_cells = np.full((num_envs, self.n_actions), -1,
+                                      dtype=np.int32)
+            self.box_slots = [
+                BoxSlots(width, height, self.n_actions,
+                         box_index=self.slot_boxes[i],
+                         cell=self.slot_cells[i], mask=self.action_masks[i])
+                for i in range(num_envs)]
+
+        self._executor = None
+        if num_threads:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                num_threads)
+            self._thread_ranges = [
+                range(num_envs * k // num_threads,
+                      num_envs * (k + 1) // num_threads)
+                for k in range(num_threads)]
+
+        self.action_space = spaces.MultiDiscrete([self.n_actions] * num_envs)
+        self.observation_space = spaces.Box(low=0, high=15,
+            shape=self.states.shape, dtype=np.uint8)
+        self.reset()
+
+    def step(self, actions):
+        actions = np.asarray(actions).reshape(self.num_envs).tolist()
+        self.times += 1
+        times = self.times.tolist()
+        if self._executor is None:
+            terminal = self._step_range(actions, times, range(self.num_envs))
+        else:
+            step_range = functools.partial(self._step_range, actions, times)
+            terminal = []
+            for chunk in self._executor.map(step_range, self._thread_ranges):
+                terminal.extend(chunk)
+
+        infos = [{} for _ in range(self.num_envs)]
+        for i, state in terminal:
+            infos[i]['terminal_observation'] = state
+        return self.states, self.rewards, self.dones, infos
+
+    def reset(self):
+        for i in range(self.num_envs):
+            self._reset_one(i)
+        return self.states
+
+    def step_indices(self, indices, actions):
+        """Step only the boards in `indices`, with one action each. Only
+        their rows of the result arrays are updated. Returns a list of
+        (index, final observation) for the boards that finished and were
+        reset."""
+        indices = list(indices)
+        self.times[indices] += 1
+        actions = dict(zip(indices, np.asarray(actions).tolist()))
+        times = dict(zip(indices, self.times[indices].tolist()))
+        return self._step_range(actions, times, indices)
+
+    def reset_indices(self, indices):
+        """Start new games on the boards in `indices` only."""
+        for i in indices:
+            self._reset_one(i)
+
+    def action_mask(self):
+        """Return the (num_envs, n_actions) boolean array of legal actions,
+        which is updated in place by `step` and `reset`."""
+        return self.action_masks
+
+    def render(self, mode='human', close=False):
+        for board in self.boards:
+            core.drawScreen(board)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _step_range(self, actions, times, indices):
+        """Step the boards in `indices`. Moves are made board by board, then
+        the observations, masks, rewards and dones of all of them are
+        computed together. Returns a list of (index, final observation) for
+        the boards that finished and were reset."""
+        box_mode = self.action_mode == 'box'
+        indices = list(indices)
+        if not indices:
+            return []
+        boards = [self.boards[i] for i in indices]
+        pre_scores = np.array([board.score for board in boards])
+        for i, board in zip(indices, boards):
+            if box_mode:
+                possible = self.box_slots[i].split(board, actions[i],
+                                                   self.transition_cache)
+            else:
+                possible = split_x_y(board, actions[i] % self.width,
+                                     actions[i] // self.width,
+                                     self.transition_cache)
+            if not possible:
+                # Punish for making impossible moves
+                board.score -= self.penalty_impossible
+
+        # A contiguous run of boards is written through a view, anything
+        # else through fancy indexing
+        rows = indices
+        if indices == list(range(indices[0], indices[-1] + 1)):
+            rows = slice(indices[0], indices[-1] + 1)
+        self.rewards[rows] = [board.score for board in boards] - pre_scores
+        if isinstance(rows, slice):
+            self.encoder.encode_many(boards, out=self.states[rows])
+        else:
+            self.states[rows] = self.encoder.encode_many(boards)
+        legal = np.stack([board.legalCells() for board in boards])
+        dones = np.array([times[i] for i in indices]) > self.max_time
+        dones |= ~legal.any(axis=(1, 2))
+        self.dones[rows] = dones
+        if not box_mode:
+            self.action_masks[rows] = legal.reshape(len(boards), -1)
+
+        terminal = []
+        for i, done in zip(indices, dones.tolist()):
+            if done:
+                terminal.append((i, self.states[i].copy()))
+                self._reset_one(i)
+            elif box_mode:
+                self.box_slots[i].update(self.boards[i])
+        return terminal
+
+    def _reset_one(self, i):
+        board = self._new_board()
+        self.boards[i] = board
+        self.times[i] = 0
+        self.encoder.encode(board, out=self.states[i])
+        if self.action_mode == 'box':
+            self.box_slots[i].update(board)
+        else:
+            self.action_masks[i] = board.legalCells().reshape(-1)
+
+    def _new_board(self):
+        board = core.Board(width=self.width, height=self.height)
+        board.profiler = self.profiler
+        return board
+
+
+def action_count(width, height, action_mode='cell', max_slots=None):
+    """Return the number of actions per board for an action mode."""
+    if action_mode == 'box':
+        return max_slots or max(1, width * height // 2)
+    return width * height
+
+
+def buffer_layout(num_envs, n_actions, width, height, n_state_layers=5):
+    """Return the shape and dtype of each result array of a `SpltVecEnv`,
+    as a dict from attribute name to (shape, dtype)."""
+    return {
+        'states': ((num_envs, n_state_layers, height, width), np.uint8),
+        'rewards': ((num_envs,), np.float64),
+        'dones': ((num_envs,), np.bool_),
+        'action_masks': ((num_envs, n_actions), np.bool_),
+    }
@@ -0,0 +1,42 @@
+"""Wire format between `gym_splt.server` and `gym_splt.client`.
+
+Every message is a frame: a header with the message kind and the length of
+the payload, then the payload. A client sends RESET, STEP with its action,
+or CLOSE, one at a time, and gets one reply to each. The server starts
+every connection with CONFIG, a JSON payload describing the env, and
+answers with OBSERVATION frames:
+
+    RESET reply:  observation, action mask
+    STEP reply:   reward, done, observation, action mask
+
+Observations are the uint8 layers of `SpltEnv`, and action masks one byte
+per action. Anything that goes wrong is answered with ERROR and a message.
+
+This module only needs the standard library, so clients do not load the
+simulator.
+"""
+import json
+import struct
+
+CONFIG = 0
+RESET = 1
+STEP = 2
+CLOSE = 3
+OBSERVATION = 4
+ERROR = 255
+
+header = struct.Struct('<BI')
+step_request = struct.Struct('<q')
+step_result = struct.Struct('<d?')
+
+
+def frame(kind, payload=b''):
+    return header.pack(kind, len(payload)) + payload
+
+
+def config_frame(config):
+    return frame(CONFIG, json.dumps(config).encode())
+
+
+def error_frame(message):
+    return frame(ERROR, message.encode())
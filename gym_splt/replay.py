@@ -0,0 +1,125 @@
+"""Rebuild positions of recorded games from their splitRecords.
+
+A game is recorded as its splitRecord, the list of box indices that were
+split. Replaying it is deterministic, so any position of the game can be
+rebuilt by replaying a prefix of the record. To avoid replaying long games
+from the start over and over, `GameCheckpoints` plays a game once and keeps
+a `core.Board.snapshot` every `interval` moves; any move is then reached by
+restoring the nearest earlier snapshot and replaying at most `interval - 1`
+moves.
+
+`replay_many` and `checkpoint_many` do the same for many games across a
+process pool. Boards travel between processes as snapshots, which are
+compact bytes and can be restored with `core.Board.restore`.
+"""
+import multiprocessing
+
+from gym_splt import core
+
+
+def replay(split_record, width=8, height=16, moves=None, board=None):
+    """Return the board after the first `moves` moves (default: all) of
+    `split_record`. If `board` is given, it is reset and reused."""
+    if moves is not None:
+        split_record = split_record[:moves]
+    if board is None:
+        return core.Board(width=width, height=height, splitRecord=split_record)
+    board.restore(core.Board(width=width, height=height).snapshot())
+    board.replay(split_record)
+    return board
+
+
+class GameCheckpoints(object):
+    """A recorded game with snapshots of every `interval`-th position, for
+    fast access to any move."""
+
+    def __init__(self, split_record, width=8, height=16, interval=32,
+                 snapshots=None):
+        self.split_record = list(split_record)
+        self.width = width
+        self.height = height
+        self.interval = interval
+        if snapshots is None:
+            snapshots = self._play()
+        # snapshots[i] is the position after i * interval moves
+        self.snapshots = snapshots
+
+    def _play(self):
+        board = core.Board(width=self.width, height=self.height)
+        snapshots = [board.snapshot()]
+        for start in range(0, len(self.split_record), self.interval):
+            board.replay(self.split_record[start:start + self.interval])
+            if len(board.splitRecord) % self.interval == 0:
+                snapshots.append(board.snapshot())
+        return snapshots
+
+    def __len__(self):
+        return len(self.split_record)
+
+    def snapshot_at(self, move):
+        """Return the snapshot of the position after `move` moves."""
+        return self.board_at(move).snapshot()
+
+    def board_at(self, move, board=None):
+        """Return the board after `move` moves. If `board` is given, it is
+        restored and reused."""
+        if not 0 <= move <= len(self.split_record):
+            raise IndexError('Move {} is outside a game of {} moves'.format(
+                move, len(self.split_record)))
+        checkpoint = min(move // self.interval, len(self.snapshots) - 1)
+        if board is None:
+            board = core.Board(width=self.width, height=self.height)
+        board.restore(self.snapshots[checkpoint])
+        board.replay(self.split_record[checkpoint * self.interval:move])
+        return board
+
+    def boards(self, moves):
+        """Yield the boards after each of `moves` moves, in order. The same
+        board object is reused, so copy what you need before advancing."""
+        board = None
+        for move in sorted(moves):
+            if (board is not None and len(board.splitRecord) <= move
+                    and move - len(board.splitRecord) < self.interval):
+                board.replay(
+                    self.split_record[len(board.splitRecord):move])
+            else:
+                board = self.board_at(move, board)
+            yield board
+
+
+def _replay_task(task):
+    split_record, width, height, moves = task
+    return replay(split_record, width, height, moves).snapshot()
+
+
+def _checkpoint_task(task):
+    split_record, width, height, interval = task
+    return GameCheckpoints(split_record, width, height, interval).snapshots
+
+
+def replay_many(split_records, width=8, height=16, moves=None, workers=None,
+                chunksize=64):
+    """Replay many recorded games across a process pool.
+
+    `moves` is None (play every record to the end), a number of moves for
+    all games, or a list with one number per game. Returns a list of
+    snapshots, one per game, in the order of `split_records`.
+    """
+    if moves is None or isinstance(moves, int):
+        moves = [moves] * len(split_records)
+    tasks = [(list(split_record), width, height, n_moves)
+             for split_record, n_moves in zip(split_records, moves)]
+    with multiprocessing.Pool(workers) as pool:
+        return pool.map(_replay_task, tasks, chunksize)
+
+
+def checkpoint_many(split_records, width=8, height=16, interval=32,
+                    workers=None, chunksize=16):
+    """Build `GameCheckpoints` for many recorded games across a process
+    pool. Returns them in the order of `split_records`."""
+    tasks = [(list(split_record), width, height, interval)
+             for split_record in split_records]
+    with multiprocessing.Pool(workers) as pool:
+        snapshots = pool.map(_checkpoint_task, tasks, chunksize)
+    return [GameCheckpoints(task[0], width, height, interval, game_snapshots)
+            for task, game_snapshots in zip(tasks, snapshots)]
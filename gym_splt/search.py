@@ -0,0 +1,469 @@
+"""Tree search over `core.Board`: Monte Carlo tree search and beam search.
+
+MCTS grows a tree of moves from a position. Each simulation walks down the
+tree with UCT, adds one new move, and plays the rest of the game with a
+rollout policy; the final score is backed up the path. Scores are
+normalized by the lowest and highest seen so far, so the exploration
+constant works the same for any board size. The tree stores no boards: a
+simulation restores the root snapshot and replays its path, which a
+`core.TransitionCache` makes cheap, as paths share their first moves.
+
+With `workers`, simulations run on a process pool. A simulation in flight
+adds a virtual loss to its path, so the next ones are steered to other
+branches, and results are backed up as they arrive.
+
+    from gym_splt import core, search
+    mcts = search.MCTS(simulations=2000, workers=4)
+    result = mcts.search(core.Board(width=8, height=16))
+    result.best_move, result.visits, result.simulations_per_second
+
+`play_game` plays a whole game with MCTS, keeping the subtree of each move,
+and returns the visit counts at every position, e.g. as policy targets.
+Rollout policies are those of `gym_splt.brute`.
+
+Usage:
+    splt-search --width 8 --height 16 --simulations 1000 --workers 4
+"""
+import argparse
+import math
+import multiprocessing
+import queue
+import random
+import sys
+import time
+
+from gym_splt import core
+from gym_splt.brute import POLICIES, get_policy
+
+
+class Node(object):
+    """A position in the MCTS tree, reached from its parent by `move`.
+
+    `untried` is None until the position has been simulated, and then lists
+    the legal moves that have no child yet. A position with no legal moves
+    keeps its final score in `terminal_score`.
+    """
+
+    __slots__ = ('move', 'parent', 'children', 'untried', 'visits',
+                 'value_sum', 'virtual', 'terminal_score')
+
+    def __init__(self, move=None, parent=None):
+        self.move = move
+        self.parent = parent
+        self.children = {}
+        self.untried = None
+        self.visits = 0
+        self.value_sum = 0.0
+        self.virtual = 0
+        self.terminal_score = None
+
+    def path(self):
+        """Return the moves from the root to this node."""
+        moves = []
+        node = self
+        while node.parent is not None:
+            moves.append(node.move)
+            node = node.parent
+        moves.reverse()
+        return moves
+
+    def mean(self):
+        return self.value_sum / self.visits if self.visits else 0.0
+
+
+class SearchResult(object):
+    """The outcome of a search from one position.
+
+    `split_record` is the whole game with the highest score found, starting
+    from the beginning of the game, and `score` its score. For MCTS,
+    `best_move` is the most visited move from the root, and `visits` and
+    `values` give the visit count and mean final score of every root move.
+    """
+
+    def __init__(self, split_record, score, best_move, visits, values,
+                 simulations, seconds):
+        self.split_record = split_record
+        self.score = score
+        self.best_move = best_move
+        self.visits = visits
+        self.values = values
+        self.simulations = simulations
+        self.seconds = seconds
+
+    @property
+    def simulations_per_second(self):
+        return self.simulations / self.seconds if self.seconds > 0 else 0.0
+
+    def __repr__(self):
+        return ('SearchResult(score={}, best_move={}, simulations={}, '
+                'simulations_per_second={:.0f})'.format(
+                    self.score, self.best_move, self.simulations,
+                    self.simulations_per_second))
+
+
+# Each process keeps one board per size, and each pool worker a transition
+# cache, so simulations reuse them rather than building new ones
+_boards = {}
+_cache = None
+
+
+def _init_worker(cache_size):
+    global _cache
+    _cache = core.TransitionCache(cache_size) if cache_size else None
+
+
+def _simulate_in_worker(task):
+    return _simulate(task, _cache)
+
+
+def _simulate(task, cache=None):
+    """Restore the root, replay the path to a leaf through `cache` and play
+    the game out.
+
+    Returns (leaf moves, final score, moves after the leaf), where leaf
+    moves are the legal moves at the leaf.
+    """
+    width, height, root, path, policy, seed = task
+    board = _boards.get((width, height))
+    if board is None:
+        board = _boards[width, height] = core.Board(width=width,
+                                                    height=height)
+    board.restore(root)
+    for move in path:
+        core.makeMove(board, move, cache=cache)
+    leaf_moves = board.getMoveOptions()
+    leaf_length = len(board.splitRecord)
+    rng = random.Random(seed)
+    move_options = leaf_moves
+    while move_options:
+        core.makeMove(board, policy(board, move_options, rng))
+        move_options = board.getMoveOptions()
+    return leaf_moves, board.score, board.splitRecord[leaf_length:]
+
+
+class MCTS(object):
+    """Monte Carlo tree search with UCT and virtual loss.
+
+    A search stops after `simulations` simulations or `time_limit` seconds,
+    whichever comes first; give None for no limit on either. With
+    `workers` > 1 simulations run on a process pool, with up to
+    `in_flight` (default: twice the workers) running at once. The pool is
+    kept between searches; call `close`, or use the object as a context
+    manager. Without workers, simulations share the transition cache in
+    `self.cache`. Without a `seed`, one is drawn from the system's random
+    source, and kept in `self.seed`.
+    """
+
+    def __init__(self, simulations=1000, time_limit=None, exploration=1.0,
+                 rollout_policy='random', workers=None, in_flight=None,
+                 virtual_loss=1, cache_size=100000, seed=None):
+        if simulations is None and time_limit is None:
+            raise ValueError('Give a simulation or time budget')
+        self.simulations = simulations
+        self.time_limit = time_limit
+        self.exploration = exploration
+        if isinstance(rollout_policy, str):
+            rollout_policy = get_policy(rollout_policy)
+        self.rollout_policy = rollout_policy
+        self.workers = workers
+        self.in_flight = in_flight or 2 * (workers or 1)
+        self.virtual_loss = virtual_loss
+        self.cache_size = cache_size
+        if seed is None:
+            seed = random.SystemRandom().getrandbits(64)
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.n_simulations = 0
+        self.pool = None
+        self.cache = None
+        if cache_size and (workers is None or workers <= 1):
+            self.cache = core.TransitionCache(cache_size)
+        self.low = None
+        self.high = None
+        self.best_score = None
+        self.best_record = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def search(self, board, root=None):
+        """Search from the position of `board`, which is left unchanged.
+
+        `root` continues the search in an existing tree for this position,
+        such as a child of the root of the previous search. Returns a
+        SearchResult; its tree is kept in `self.root`.
+        """
+        if root is None:
+            root = Node()
+            self.low = self.high = None
+            self.best_score = self.best_record = None
+        root.parent = None
+        if root.untried is None:
+            root.untried = board.getMoveOptions()
+            if not root.untried and not root.children:
+                root.terminal_score = board.score
+        self.root = root
+        snapshot = board.snapshot()
+        prefix = list(board.splitRecord)
+        if self.best_score is None or board.score > self.best_score:
+            self.best_score, self.best_record = board.score, prefix
+
+        start = time.perf_counter()
+        deadline = None if self.time_limit is None else start + self.time_limit
+        started = 0
+
+        def budget_left():
+            if root.terminal_score is not None:
+                return False  # The game is already over
+            if self.simulations is not None and started >= self.simulations:
+                return False
+            return deadline is None or time.perf_counter() < deadline
+
+        def task(leaf):
+            self.n_simulations += 1
+            return (board.width, board.height, snapshot, leaf.path(),
+                    self.rollout_policy,
+                    '{}-{}'.format(self.seed, self.n_simulations))
+
+        if self.workers is None or self.workers <= 1:
+            while budget_left():
+                started += 1
+                leaf = self._select(root)
+                if leaf.terminal_score is not None:
+                    self._backup(leaf, leaf.terminal_score, 0)
+                    continue
+                self._finish(leaf, prefix, _simulate(task(leaf), self.cache),
+                             0)
+        else:
+            if self.pool is None:
+                self.pool = multiprocessing.Pool(
+                    self.workers, _init_worker, (self.cache_size,))
+            results = queue.Queue()
+            pending = 0
+            while True:
+                while pending < self.in_flight and budget_left():
+                    started += 1
+                    leaf = self._select(root)
+                    if leaf.terminal_score is not None:
+                        self._backup(leaf, leaf.terminal_score, 0)
+                        continue
+                    self._add_virtual_loss(leaf)
+                    self.pool.apply_async(
+                        _simulate_in_worker, (task(leaf),),
+                        callback=lambda result, leaf=leaf: results.put(
+                            (leaf, result, None)),
+                        error_callback=lambda error: results.put(
+                            (None, None, error)))
+                    pending += 1
+                if not pending:
+                    break
+                leaf, result, error = results.get()
+                pending -= 1
+                if error is not None:
+                    raise error
+                self._finish(leaf, prefix, result, self.virtual_loss)
+        seconds = time.perf_counter() - start
+
+        visits = {move: child.visits for move, child in root.children.items()}
+        values = {move: child.mean() for move, child in root.children.items()}
+        best_move = max(visits, key=visits.get) if visits else None
+        return SearchResult(self.best_record, self.best_score, best_move,
+                            visits, values, started, seconds)
+
+    def _select(self, node):
+        """Walk down from `node` to the leaf to simulate next, adding a child
+        for an untried move on the way if there is one."""
+        while True:
+            if node.untried is None or node.terminal_score is not None:
+                # Not simulated yet, or the game is over
+                return node
+            if node.untried:
+                move = node.untried.pop(self.rng.randrange(len(node.untried)))
+                child = node.children[move] = Node(move, node)
+                return child
+            node = max(node.children.values(), key=self._uct(node))
+
+    def _uct(self, parent):
+        low, high = self.low, self.high
+        spread = high - low if low is not None and high > low else None
+        log_total = math.log(parent.visits + parent.virtual)
+        exploration = self.exploration
+
+        def score(child):
+            n = child.visits + child.virtual
+            if low is None:
+                q = 0.5
+            else:
+                # Virtual losses count as the lowest score seen
+                q = (child.value_sum + child.virtual * low) / n
+                q = (q - low) / spread if spread else 0.5
+            return q + exploration * math.sqrt(log_total / n)
+        return score
+
+    def _add_virtual_loss(self, leaf):
+        node = leaf
+        while node is not None:
+            node.virtual += self.virtual_loss
+            node = node.parent
+
+    def _finish(self, leaf, prefix, result, virtual_loss):
+        leaf_moves, score, rollout = result
+        if leaf.untried is None:
+            leaf.untried = [move for move in leaf_moves
+                            if move not in leaf.children]
+            if not leaf_moves:
+                leaf.terminal_score = score
+        if self.best_score is None or score > self.best_score:
+            self.best_score = score
+            self.best_record = prefix + leaf.path() + rollout
+        self._backup(leaf, score, virtual_loss)
+
+    def _backup(self, leaf, score, virtual_loss):
+        self.low = score if self.low is None else min(self.low, score)
+        self.high = score if self.high is None else max(self.high, score)
+        node = leaf
+        while node is not None:
+            node.visits += 1
+            node.value_sum += score
+            node.virtual -= virtual_loss
+            node = node.parent
+
+
+def play_game(width=8, height=16, mcts=None, callback=None):
+    """Play a whole game, making the most visited move of an MCTS search at
+    every position and keeping its subtree for the next search.
+
+    Returns (split_record, score, targets): the game that was played (or
+    a better one found during search), its score, and for every position
+    of the played game the visit counts of its moves. `callback(board,
+    result)` is called after each search.
+    """
+    if mcts is None:
+        mcts = MCTS()
+    board = core.Board(width=width, height=height)
+    targets = []
+    root = None
+    best_record, best_score = [], 0
+    while board.getMoveOptions():
+        result = mcts.search(board, root)
+        if callback is not None:
+            callback(board, result)
+        targets.append(result.visits)
+        if result.score > best_score:
+            best_record, best_score = result.split_record, result.score
+        move = result.best_move
+        if move is None:
+            # The budget ran out before a single simulation finished
+            move = board.getMoveOptions()[0]
+        root = mcts.root.children.get(move)
+        core.makeMove(board, move)
+    if board.score >= best_score:
+        best_record, best_score = list(board.splitRecord), board.score
+    return best_record, best_score, targets
+
+
+def beam_search(board, beam_width=64, depth=None):
+    """Breadth-first search keeping the `beam_width` highest scoring
+    positions at each depth, for at most `depth` moves (default: until no
+    position has a legal move). Positions reached by different orders of
+    moves are only kept once. `board` is left unchanged.
+
+    Returns a SearchResult with the best position found; its simulations
+    are the positions expanded.
+    """
+    start = time.perf_counter()
+    work = core.Board(width=board.width, height=board.height)
+    beam = [board.snapshot()]
+    best_record, best_score = list(board.splitRecord), board.score
+    expanded = 0
+    moves = 0
+    # Children that were already found are restored here to compare them
+    # with a new one whose hash is the same
+    other = core.Board(width=board.width, height=board.height)
+    while beam and (depth is None or moves < depth):
+        # Hash -> [(score, snapshot)], one entry per distinct position
+        children = {}
+        for snapshot in beam:
+            work.restore(snapshot)
+            expanded += 1
+            for move in work.getMoveOptions():
+                core.makeMove(work, move, undo=True)
+                same_hash = children.setdefault(work.zobrist, [])
+                for i, (score, child) in enumerate(same_hash):
+                    other.restore(child)
+                    if other == work:
+                        if work.score > score:
+                            same_hash[i] = (work.score, work.snapshot())
+                        break
+                else:
+                    same_hash.append((work.score, work.snapshot()))
+                if work.score > best_score:
+                    best_record, best_score = list(work.splitRecord), work.score
+                core.undoMove(work)
+        ranked = sorted((child for same_hash in children.values()
+                         for child in same_hash),
+                        key=lambda child: -child[0])
+        beam = [snapshot for _, snapshot in ranked[:beam_width]]
+        moves += 1
+    return SearchResult(best_record, best_score, None, {}, {}, expanded,
+                        time.perf_counter() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Play an SPL-T game with tree search.')
+    parser.add_argument('--width', type=int, default=8)
+    parser.add_argument('--height', type=int, default=16)
+    parser.add_argument('--algorithm', choices=['mcts', 'beam'],
+                        default='mcts')
+    parser.add_argument('--simulations', type=int, default=1000,
+                        help='MCTS simulations per move')
+    parser.add_argument('--time-limit', type=float, default=None,
+                        help='MCTS seconds per move')
+    parser.add_argument('--exploration', type=float, default=1.0)
+    parser.add_argument('--policy', default='random',
+                        help='rollout policy, one of {} or module:function'
+                             .format(', '.join(sorted(POLICIES))))
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes for MCTS (default: none)')
+    parser.add_argument('--beam-width', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    if args.algorithm == 'beam':
+        result = beam_search(core.Board(width=args.width, height=args.height),
+                             args.beam_width)
+        print('Expanded {} positions in {:.1f}s ({:.0f} positions/s)'.format(
+            result.simulations, result.seconds,
+            result.simulations_per_second))
+        record, score = result.split_record, result.score
+    else:
+        def report(board, result):
+            print('Move {}: {} simulations, {:.0f} simulations/s, best '
+                  'score so far {}'.format(
+                      len(board.splitRecord) + 1, result.simulations,
+                      result.simulations_per_second, result.score))
+            sys.stdout.flush()
+
+        with MCTS(args.simulations, args.time_limit, args.exploration,
+                  args.policy, args.workers, seed=args.seed) as mcts:
+            record, score, _ = play_game(args.width, args.height, mcts,
+                                         callback=report)
+            print('{} simulations in {:.1f}s ({:.0f} simulations/s)'.format(
+                mcts.n_simulations, time.time() - start,
+                mcts.n_simulations / (time.time() - start)))
+    print('Score {}: {}'.format(score, record))
+
+
+if __name__ == '__main__':
+    main()
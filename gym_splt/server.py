@@ -0,0 +1,228 @@
+"""Host a pool of SPL-T boards for many actor processes.
+
+Each client connection gets a board of one big `SpltVecEnv`. An asyncio
+front end reads requests from all connections, and step requests are
+gathered into batches: a batch is stepped once every connected client is
+waiting for a step, or `max_wait` seconds after its first request, or once
+it holds `max_batch` requests. Batches and resets are run one at a time on
+a worker thread, so the event loop keeps reading the next requests while a
+batch is stepped.
+
+The matching client is `gym_splt.client.SpltClientEnv`, a `gym.Env` that
+only needs gym and numpy. See `gym_splt.protocol` for the wire format.
+
+Usage:
+    splt-server --unix /tmp/splt.sock --capacity 1024 --width 8 --height 16
+    splt-server --host 127.0.0.1 --port 7777
+"""
+import argparse
+import asyncio
+import concurrent.futures
+
+import numpy as np
+
+from gym_splt import protocol
+from gym_splt.envs.splt_vec_env import SpltVecEnv
+
+
+class SpltServer(object):
+    """Serves up to `capacity` clients, each playing on its own board. The
+    other arguments configure the boards as for `SpltVecEnv`."""
+
+    def __init__(self, capacity=1024, width=4, height=8, max_time=500,
+                 action_mode='cell', max_slots=None, transition_cache=None,
+                 max_batch=None, max_wait=0.001):
+        self.pool = SpltVecEnv(capacity, width, height, max_time,
+                               transition_cache, action_mode, max_slots)
+        self.capacity = capacity
+        self.max_batch = max_batch or capacity
+        self.max_wait = max_wait
+        self.free_slots = list(range(capacity - 1, -1, -1))
+        self.config = {
+            'width': width,
+            'height': height,
+            'max_time': max_time,
+            'action_mode': action_mode,
+            'n_actions': self.pool.n_actions,
+            'observation_shape': list(self.pool.states.shape[1:]),
+        }
+        self.no_actions = np.zeros(self.pool.n_actions, dtype=bool)
+        # Set when a step ends the game on a board, until its client resets
+        self.game_over = np.zeros(capacity, dtype=bool)
+        self.pending = []  # (slot, action, future) of waiting step requests
+        self.n_clients = 0
+        self.batches = 0
+        self.steps = 0
+        self._arrived = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(1)
+
+    async def start(self, path=None, host='127.0.0.1', port=7777):
+        """Start serving on the Unix socket `path`, or on TCP if path is
+        None. Returns the asyncio server."""
+        self._arrived = asyncio.Event()
+        self._batcher = asyncio.ensure_future(self._batch_loop())
+        if path is not None:
+            return await asyncio.start_unix_server(self._handle, path)
+        return await asyncio.start_server(self._handle, host, port)
+
+    def run(self, path=None, host='127.0.0.1', port=7777):
+        """Serve until interrupted."""
+        async def serve():
+            server = await self.start(path, host, port)
+            async with server:
+                await server.serve_forever()
+        try:
+            asyncio.run(serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        self._executor.shutdown()
+        self.pool.close()
+
+    async def _handle(self, reader, writer):
+        if not self.free_slots:
+            writer.write(protocol.error_frame(
+                'All {} boards are in use'.format(self.capacity)))
+            await writer.drain()
+            writer.close()
+            return
+        slot = self.free_slots.pop()
+        self.n_clients += 1
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(self._executor, self._reset, slot)
+            writer.write(protocol.config_frame(dict(self.config, slot=slot)))
+            await writer.drain()
+            while True:
+                kind, length = protocol.header.unpack(
+                    await reader.readexactly(protocol.header.size))
+                payload = await reader.readexactly(length)
+                if kind == protocol.STEP:
+                    action, = protocol.step_request.unpack(payload)
+                    if not 0 <= action < self.pool.n_actions:
+                        reply = protocol.error_frame(
+                            'Action {} is not in [0, {})'.format(
+                                action, self.pool.n_actions))
+                    elif self.game_over[slot]:
+                        reply = protocol.error_frame(
+                            'The game is over, reset before stepping again')
+                    else:
+                        future = loop.create_future()
+                        self.pending.append((slot, action, future))
+                        self._arrived.set()
+                        reply = await future
+                elif kind == protocol.RESET:
+                    reply = await loop.run_in_executor(
+                        self._executor, self._reset, slot)
+                elif kind == protocol.CLOSE:
+                    break
+                else:
+                    reply = protocol.error_frame(
+                        'Unknown message kind {}'.format(kind))
+                writer.write(reply)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass  # The client went away
+        finally:
+            self.n_clients -= 1
+            self.free_slots.append(slot)
+            writer.close()
+
+    async def _batch_loop(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            while not self.pending:
+                self._arrived.clear()
+                await self._arrived.wait()
+            # Give the other clients a moment to send their steps too
+            deadline = loop.time() + self.max_wait
+            while len(self.pending) < min(self.n_clients, self.max_batch):
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                self._arrived.clear()
+                try:
+                    await asyncio.wait_for(self._arrived.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            batch = self.pending[:self.max_batch]
+            del self.pending[:self.max_batch]
+            try:
+                replies = await loop.run_in_executor(
+                    self._executor, self._step, batch)
+            except Exception as exception:
+                # Answer the whole batch with the error, and carry on with
+                # the next one
+                replies = [protocol.error_frame(
+                    'Step failed: {!r}'.format(exception))] * len(batch)
+            for (_, _, future), reply in zip(batch, replies):
+                if not future.done():
+                    future.set_result(reply)
+
+    def _step(self, batch):
+        """Step the boards of a batch of requests. Returns a reply frame for
+        each request."""
+        slots = [slot for slot, _, _ in batch]
+        terminal = dict(self.pool.step_indices(
+            slots, [action for _, action, _ in batch]))
+        self.batches += 1
+        self.steps += len(batch)
+        pool = self.pool
+        replies = []
+        for slot in slots:
+            done = bool(pool.dones[slot])
+            if done:
+                self.game_over[slot] = True
+                # The board has already started a new game. Until the client
+                # resets, no action is legal
+                observation, mask = terminal[slot], self.no_actions
+            else:
+                observation, mask = pool.states[slot], pool.action_masks[slot]
+            replies.append(protocol.frame(
+                protocol.OBSERVATION,
+                protocol.step_result.pack(float(pool.rewards[slot]), done)
+                + observation.tobytes() + mask.tobytes()))
+        return replies
+
+    def _reset(self, slot):
+        self.pool.reset_indices([slot])
+        self.game_over[slot] = False
+        return protocol.frame(
+            protocol.OBSERVATION,
+            self.pool.states[slot].tobytes()
+            + self.pool.action_masks[slot].tobytes())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Serve SPL-T boards to gym_splt.client actors.')
+    parser.add_argument('--unix', default=None,
+                        help='listen on this Unix socket instead of TCP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7777)
+    parser.add_argument('--capacity', type=int, default=1024,
+                        help='number of boards, the most clients at once')
+    parser.add_argument('--width', type=int, default=4)
+    parser.add_argument('--height', type=int, default=8)
+    parser.add_argument('--max-time', type=int, default=500)
+    parser.add_argument('--action-mode', choices=['cell', 'box'],
+                        default='cell')
+    parser.add_argument('--max-batch', type=int, default=None)
+    parser.add_argument('--max-wait', type=float, default=0.001,
+                        help='seconds to wait for more steps to batch')
+    args = parser.parse_args(argv)
+
+    server = SpltServer(args.capacity, args.width, args.height,
+                        args.max_time, args.action_mode,
+                        max_batch=args.max_batch, max_wait=args.max_wait)
+    print('Serving {} {}x{} boards on {}'.format(
+        args.capacity, args.width, args.height,
+        args.unix or '{}:{}'.format(args.host, args.port)))
+    server.run(args.unix, args.host, args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,5 +3,10 @@ from setuptools import setup
 setup(
     name='gym_splt',
     version='0.0.1',
-    install_requires=['gym', 'numpy']
+    install_requires=['gym', 'numpy'],
+    entry_points={
+        'console_scripts': ['splt-brute=gym_splt.brute:main',
+                            'splt-search=gym_splt.search:main',
+                            'splt-server=gym_splt.server:main'],
+    },
 )
\ No newline at end of file